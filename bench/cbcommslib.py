@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# cbcommslib.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+"""
+Stand-in for the bridge's cbcommslib, used only by eew_bench.py. The real
+CbApp connects to the bridge manager and concentrator; this one just counts
+what the app sends.
+"""
+
+class CbApp:
+    def __init__(self, argv):
+        self.id = "app1"
+        self.bridge_id = "BID0"
+        self.sentMessages = 0
+        self.managerMessages = []
+        self.adaptorRequests = []
+
+    def sendMessage(self, msg, dest):
+        self.sentMessages += 1
+        if dest != "conc" and msg.get("request") == "service":
+            self.adaptorRequests.append((dest, msg))
+
+    def sendManagerMessage(self, msg):
+        self.managerMessages.append(msg)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# cbconfig.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" Stand-in for the bridge's cbconfig, used only by eew_bench.py """
+import os
+import logging
+import tempfile
+
+CB_CONFIG_DIR = os.environ.get("CB_CONFIG_DIR") or tempfile.mkdtemp(prefix="eew_bench_") + "/"
+CB_LOGFILE = os.environ.get("CB_LOGFILE", CB_CONFIG_DIR + "eew_bench.log")
+CB_LOGGING_LEVEL = getattr(logging, os.environ.get("CB_LOGGING_LEVEL", "WARNING"))
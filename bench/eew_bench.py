@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# eew_bench.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+"""
+Replay benchmark for eew_app. Runs App against the stand-in cbcommslib and
+cbconfig in this directory, feeds it a synthetic onAdaptorService and
+onAdaptorData stream and points DataManager at a local HTTP sink, then
+reports ingest rate, sample-to-upload latency, peak RSS and what was sent.
+
+    python bench/eew_bench.py --devices 40 --duration 30
+    python bench/eew_bench.py --flood --set upload_engine=async --output new.json --baseline old.json
+    python bench/eew_bench.py --replay /path/to/record_dir --set temp_compression_error=0.2
+    python bench/eew_bench.py --broker --archive /tmp/eew_archive --set batch_upload=true
+
+--mix gives the characteristics each device offers and their rates in
+samples per second. --replay feeds a directory recorded on a bridge with
+record_dir, as fast as it will go, instead of synthetic data. --broker adds a
+second HTTP sink, standing in for a local message broker, and --archive a
+file sink. --set overrides any eew_app config value (JSON values
+are parsed, anything else is taken as a string); overrides are written to
+eew_app.config in the stand-in CB_CONFIG_DIR.
+"""
+import os
+import sys
+import time
+import json
+import gzip
+import random
+import resource
+import argparse
+import itertools
+from io import BytesIO
+
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+from twisted.internet import reactor, task
+from twisted.web import server, resource as webresource
+import eew_app_a
+
+DEFAULT_MIX = "temperature:0.5,humidity:0.5,luminance:0.5,power:1,binary_sensor:0.2,connected:0.05,acceleration:5"
+
+class Sink(webresource.Resource):
+    """ Local stand-in for Geras, recording what arrives and when """
+    isLeaf = True
+
+    def __init__(self, failRate):
+        webresource.Resource.__init__(self)
+        self.failRate = failRate
+        self.requests = 0
+        self.failed = 0
+        self.bytes = 0
+        self.entries = 0
+        self.latencies = []
+
+    def render_POST(self, request):
+        body = request.content.read()
+        self.requests += 1
+        self.bytes += len(body)
+        if random.random() < self.failRate:
+            self.failed += 1
+            request.setResponseCode(503)
+            return b""
+        if request.getHeader("content-encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+        doc = json.loads(body.decode("utf-8"))
+        now = time.time()
+        bt = doc.get("bt", 0)
+        for e in doc["e"]:
+            self.latencies.append(now - (bt + e["t"]))
+        self.entries += len(doc["e"])
+        return b""
+
+class Signal:
+    """ Plausible values for one characteristic of one device """
+    def __init__(self, characteristic):
+        self.characteristic = characteristic
+        self.level = {"temperature": 20.0, "ir_temperature": 22.0, "humidity": 50.0,
+                      "luminance": 200.0, "power": 100.0, "battery": 100.0}.get(characteristic, 0.0)
+        self.state = False
+
+    def next(self):
+        c = self.characteristic
+        if c in ("temperature", "ir_temperature", "humidity"):
+            self.level += random.gauss(0, 0.1)
+            return self.level
+        if c == "luminance":
+            self.level = max(0.0, self.level + random.gauss(0, 2.0))
+            return self.level
+        if c == "power":
+            if random.random() < 0.05:
+                self.level = random.choice([0.0, 5.0, 100.0, 2000.0])
+            return self.level + random.gauss(0, 0.5)
+        if c == "battery":
+            self.level = max(0.0, self.level - 0.01)
+            return self.level
+        if c in ("binary_sensor", "connected"):
+            if random.random() < 0.05:
+                self.state = not self.state
+            if c == "connected":
+                return self.state
+            return "on" if self.state else "off"
+        if c in ("acceleration", "gyro", "magnetometer"):
+            sigma = {"acceleration": 0.03, "gyro": 0.7, "magnetometer": 2.0}[c]
+            return {"x": random.gauss(0, sigma), "y": random.gauss(0, sigma), "z": 1.0 + random.gauss(0, sigma)}
+        if c == "buttons":
+            return {"leftButton": int(random.random() < 0.01), "rightButton": 0}
+        return 0.0
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.mix = []
+        for item in args.mix.split(","):
+            characteristic, rate = item.split(":")
+            self.mix.append((characteristic, float(rate)))
+        self.recording = None
+        if args.replay:
+            self.devices = eew_app_a.recordingDevices(args.replay)
+            self.recording = itertools.chain(*[eew_app_a.readRecording(path, self.devices)
+                                               for path in eew_app_a.recordingFiles(args.replay)])
+            self.mix = [(characteristic, 0) for characteristic in eew_app_a.RECORD_CODES]
+        overrides = {}
+        for characteristic, rate in self.mix:
+            overrides[eew_app_a.SERIES[characteristic].enable] = 'True'
+        self.sink = Sink(args.fail_rate)
+        self.port = reactor.listenTCP(0, server.Site(self.sink), interface="127.0.0.1")
+        overrides["geras_url"] = "http://127.0.0.1:%d/series/" % self.port.getHost().port
+        sinks = [{"name": "geras", "type": "http"}]
+        self.broker = None
+        if args.broker:
+            self.broker = Sink(0.0)
+            self.brokerPort = reactor.listenTCP(0, server.Site(self.broker), interface="127.0.0.1")
+            sinks.append({"name": "broker", "type": "http", "key": "", "bulk": True,
+                          "url": "http://127.0.0.1:%d/eew/" % self.brokerPort.getHost().port})
+        if args.archive:
+            sinks.append({"name": "archive", "type": "file", "path": args.archive})
+        overrides["sinks"] = sinks
+        for setting in args.set:
+            key, value = setting.split("=", 1)
+            try:
+                overrides[key] = json.loads(value)
+            except ValueError:
+                overrides[key] = value
+        # App reads its settings from eew_app.config, as it does on a bridge
+        with open(eew_app_a.CB_CONFIG_DIR + "eew_app.config", "w") as f:
+            json.dump(overrides, f)
+        self.app = eew_app_a.App([])
+        self.messages = 0
+        self.ingestTime = 0.0
+        self.streams = []
+
+    def start(self):
+        if self.recording:
+            adaptors = [{"id": adtID, "name": "bench", "friendly_name": name} for adtID, name in self.devices]
+        else:
+            adaptors = [{"id": "ADT%d" % d, "name": "bench", "friendly_name": "Bench %d" % d}
+                        for d in range(self.args.devices)]
+        self.app.onConfigureMessage({"adaptors": adaptors})
+        for adaptor in adaptors:
+            self.app.onAdaptorService({"id": adaptor["id"],
+                                       "service": [{"characteristic": c, "interval": 0} for c, r in self.mix]})
+        if not self.recording:
+            for adaptor in adaptors:
+                for characteristic, rate in self.mix:
+                    self.streams.append([adaptor["id"], characteristic, rate, Signal(characteristic), random.random()])
+            reactor.callLater(self.args.duration, self.stopFeeding)
+        self.started = time.time()
+        self.last = self.started
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.start(self.args.tick)
+
+    def tick(self):
+        now = time.time()
+        dt = now - self.last
+        self.last = now
+        batch = []
+        if self.recording:
+            batch = list(itertools.islice(self.recording, self.args.replay_batch))
+            if not batch:
+                self.stopFeeding()
+                return
+        for stream in self.streams:
+            if self.args.flood:
+                due = self.args.flood_batch
+            else:
+                stream[4] += stream[2]*dt
+                due = int(stream[4])
+                stream[4] -= due
+            for i in range(due):
+                batch.append({"id": stream[0], "characteristic": stream[1], "timeStamp": now, "data": stream[3].next()})
+        t = time.time()
+        for message in batch:
+            self.app.onAdaptorData(message)
+        # Process them now rather than on App's own tick, so they are timed
+        self.app.drainIngest()
+        self.ingestTime += time.time() - t
+        self.messages += len(batch)
+
+    def stopFeeding(self):
+        self.loop.stop()
+        self.feedTime = time.time() - self.started
+        reactor.callLater(self.args.drain, reactor.stop)
+
+    def results(self):
+        latencies = sorted(self.sink.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p*len(latencies)))], 4)
+        return {"devices": len(self.devices) if self.recording else self.args.devices,
+                "mix": self.args.mix,
+                "messages": self.messages,
+                "offered_msgs_per_sec": round(self.messages/self.feedTime, 1),
+                "ingest_msgs_per_sec": round(self.messages/self.ingestTime, 1) if self.ingestTime else None,
+                "samples_uploaded": self.sink.entries,
+                "requests": self.sink.requests,
+                "failed_requests": self.sink.failed,
+                "bytes_sent": self.sink.bytes,
+                "latency_p50": percentile(0.5),
+                "latency_p90": percentile(0.9),
+                "latency_p99": percentile(0.99),
+                "latency_max": percentile(1.0),
+                "broker_samples": self.broker.entries if self.broker else None,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def report(results, baseline):
+    for key in sorted(results):
+        line = "%-22s %s" % (key, results[key])
+        if baseline and isinstance(results[key], (int, float)) and isinstance(baseline.get(key), (int, float)):
+            old = baseline[key]
+            if old:
+                line += "  (baseline %s, %+.1f%%)" % (old, 100.0*(results[key] - old)/old)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark for eew_app")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="characteristic:rate,... per device")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of data to feed")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to wait for uploads afterwards")
+    parser.add_argument("--tick", type=float, default=0.05, help="seconds between feed batches")
+    parser.add_argument("--flood", action="store_true", help="feed as fast as possible rather than at the mix rates")
+    parser.add_argument("--flood-batch", type=int, default=20, help="samples per stream per tick when flooding")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests the sink refuses")
+    parser.add_argument("--set", action="append", default=[], help="key=value eew_app config override")
+    parser.add_argument("--replay", help="record_dir to feed instead of synthetic data")
+    parser.add_argument("--replay-batch", type=int, default=2000, help="recorded samples per tick")
+    parser.add_argument("--broker", action="store_true", help="also send to a local broker stand-in")
+    parser.add_argument("--archive", help="also archive to this directory")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    bench = Bench(args)
+    reactor.callWhenRunning(bench.start)
+    reactor.run()
+    results = bench.results()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
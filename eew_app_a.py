@@ -11,20 +11,49 @@ import sys
 import os.path
 import time
 import logging
+import threading
+import collections
+import random
+import bisect
+import cProfile
+import sqlite3
+import struct
+import mmap
+from array import array
 from cbcommslib import CbApp
 from cbconfig import *
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from twisted.internet import reactor
+import base64
+import gzip
+from io import BytesIO
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from twisted.internet import reactor, task, defer
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
 
 # Default values:
 config = {
     'temperature': 'True',
     'temp_min_change': 0.2,
+    'temp_compression_error': 0.0,
+    'temp_rollup_interval': 0,
     'irtemperature': 'False',
     'irtemp_min_change': 0.5,
+    'irtemp_compression_error': 0.0,
+    'irtemp_rollup_interval': 0,
     'humidity': 'True',
     'humidity_min_change': 0.2,
+    'humidity_compression_error': 0.0,
+    'humidity_rollup_interval': 0,
     'buttons': 'False',
     'accel': 'False',
     'accel_min_change': 0.02,
@@ -35,333 +64,1891 @@ config = {
     'magnet': 'False',
     'magnet_min_change': 1.5,
     'magnet_polling_interval': 3.0,
+    'motion_mode': 'deadband',
+    'motion_window': 60.0,
     'binary': 'True',
     'luminance': 'True',
     'luminance_min_change': 1.0,
+    'luminance_compression_error': 0.0,
+    'luminance_rollup_interval': 0,
     'power': 'True',
     'power_min_change': 1.0,
+    'power_compression_error': 0.0,
+    'power_rollup_interval': 0,
+    'power_rollup_aggregates': ['twmean', 'max'],
     'battery': 'True',
     'battery_min_change': 1.0,
+    'battery_compression_error': 0.0,
+    'battery_rollup_interval': 0,
     'connected': 'True',
+    'compression_heartbeat': 3600.0,
+    'rollup_aggregates': ['mean', 'min', 'max'],
+    'rollup_max_fill': 1440,
     'slow_polling_interval': 600.0,
     'send_delay': 3.0,
-    'geras_key': 'ea2f0e06ff8123b7f46f77a3a451731a'
+    'batch_upload': 'False',
+    'bulk_url': '',
+    'bulk_max_entries': 1000,
+    'payload_encoding': 'json',
+    'payload_gzip': 'False',
+    'spool_memory_limit': 2000,
+    'retry_base_delay': 3.0,
+    'retry_max_delay': 600.0,
+    'breaker_threshold': 5,
+    'upload_engine': 'thread',
+    'upload_workers': 2,
+    'upload_queue_size': 20,
+    'upload_queue_policy': 'coalesce',
+    'http_pool_size': 4,
+    'http_connect_timeout': 5.0,
+    'http_read_timeout': 20.0,
+    'shutdown_upload_timeout': 10.0,
+    'backpressure_interval': 10.0,
+    'backpressure_samples': [5000, 20000],
+    'backpressure_age': [600.0, 3600.0],
+    'backpressure_deadband_factor': 5.0,
+    'metrics_interval': 0,
+    'metrics_file': '',
+    'profile_every': 0,
+    'geras_url': 'http://geras.1248.io/series/',
+    'geras_key': 'ea2f0e06ff8123b7f46f77a3a451731a',
+    'sinks': [{"name": "geras", "type": "http"}],
+    'config_watch_interval': 30.0,
+    'record_dir': '',
+    'record_file_size': 16777216,
+    'record_files': 8,
+    'history_size': 360,
+    'history_raw': 'True',
+    'ingest_interval': 0.05,
+    'ingest_queue_size': 100000,
+    'flush_max_samples': 1000,
+    'flush_max_bytes': 65536,
+    'flush_min_samples': 20,
+    'flush_rate_window': 60.0,
+    'flush_min_wait': 1.0,
+    'latency_classes': {"immediate": [0.0, 0.0], "normal": [3.0, 30.0], "bulk": [30.0, 300.0]},
+    'latency_class': {"binary_sensor": "immediate", "connected": "immediate", "buttons": "immediate",
+                      "temperature": "bulk", "ir_temperature": "bulk", "humidity": "bulk", "battery": "bulk"},
+    'snapshot_interval': 300.0,
+    'polling_adapt_interval': 600.0,
+    'polling_pass_low': 0.05,
+    'polling_pass_high': 0.5,
+    'polling_min_factor': 1.0,
+    'polling_max_factor': 8.0,
+    'polling_min_samples': 10
 }
+defaultConfig = dict(config)
 
-class DataManager:
-    """ Managers data storage for all sensors """
-    def __init__(self, bridge_id):
-        self.baseurl = "http://geras.1248.io/series/" + bridge_id + "/"
-        self.s={}
-        self.waiting=[]
+def normaliseConfig(c):
+    """ Strings such as "True" and "false" become booleans """
+    for key, v in c.items():
+        if hasattr(v, "lower"):
+            if v.lower() in ("true", "t", "1"):
+                c[key] = True
+            elif v.lower() in ("false", "f", "0"):
+                c[key] = False
+
+normaliseConfig(config)
+
+def loadConfig():
+    """
+    Defaults overlaid with eew_app.config, checked and compiled into series
+    parameters before anything is changed. Returns the parameters, or None
+    if the file is unusable, in which case config is left as it was.
+    Otherwise config is updated in place, key by key, so that it can be
+    reloaded while other threads are reading it.
+    """
+    newConfig = dict(defaultConfig)
+    try:
+        with open(CB_CONFIG_DIR + "eew_app.config", 'r') as configFile:
+            newConfig.update(json.load(configFile))
+            logging.info('%s Read eew_app.config', ModuleName)
+    except Exception as ex:
+        logging.warning('%s eew_app.config does not exist or file is corrupt', ModuleName)
+        logging.warning("%s Exception: %s %s", ModuleName, type(ex), str(ex.args))
+    normaliseConfig(newConfig)
+    try:
+        for key, default in defaultConfig.items():
+            if isinstance(default, (int, float)) and not isinstance(default, bool):
+                float(newConfig[key])
+        params = compileSeries(newConfig)
+    except Exception as ex:
+        logging.warning("%s eew_app.config rejected, keeping current settings: %s %s", ModuleName, type(ex), str(ex.args))
+        return None
+    config.update(newConfig)
+    logging.debug('%s Config: %s', ModuleName, config)
+    return params
+
+if ujson:
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+class PayloadEncoder:
+    """
+    Builds request bodies for an endpoint. encoding is either:
+        json: {"e": values} as they are
+        senml: the legacy SenML object from before RFC 8428,
+               {"bn": ..., "bt": ..., "e": [{"n", "v", "t"}, ...]}, entries
+               sorted by name. "t" is relative to the base time "bt", to the
+               millisecond. The base name "bn" is only set when every name
+               shares a device prefix, as with the bulk endpoint, so per-device
+               requests only save the absolute times
+    With gzip the body is compressed and sent with Content-Encoding: gzip.
+    """
+    def __init__(self, encoding, gzip):
+        self.encoding = encoding
+        self.gzip = gzip
+        self.headers = {"Content-Type": "application/json"}
+        if gzip:
+            self.headers["Content-Encoding"] = "gzip"
+
+    def encode(self, values):
+        if self.encoding == "senml":
+            body = dumps(self.senml(values))
+        else:
+            body = dumps({"e": values})
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        if self.gzip:
+            buf = BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as f:
+                f.write(body)
+            body = buf.getvalue()
+        return body
+
+    def senml(self, values):
+        if not values:
+            return {"e": []}
+        bt = min(v["t"] for v in values)
+        bn = ""
+        first = values[0]["n"]
+        if "/" in first:
+            prefix = first[:first.index("/") + 1]
+            if all(v["n"].startswith(prefix) for v in values):
+                bn = prefix
+        cut = len(bn)
+        entries = [{"n": v["n"][cut:], "v": v["v"], "t": round(v["t"] - bt, 3)}
+                   for v in sorted(values, key=lambda v: v["n"])]
+        senml = {"bt": bt, "e": entries}
+        if bn:
+            senml["bn"] = bn
+        return senml
+
+class GerasEndpoint:
+    """ Geras per-device scheme: one POST to <baseurl><deviceID> for each device """
+    def __init__(self):
+        self.key = ("device",)
+
+    def split(self, batch):
+        """ batch maps deviceID to values. Returns a list of (path, batch part, values) requests """
+        return [(deviceID, {deviceID: values}, values) for deviceID, values in batch.items()]
+
+class BulkEndpoint:
+    """ All devices in as few POSTs to one URL as possible, series names prefixed by deviceID """
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.key = ("bulk", maxEntries)
+
+    def split(self, batch):
+        reqs = []
+        part = {}
+        entries = []
+        for deviceID, values in batch.items():
+            if entries and len(entries) + len(values) > self.maxEntries:
+                reqs.append(("", part, entries))
+                part = {}
+                entries = []
+            part[deviceID] = values
+            for v in values:
+                entries.append({"n": deviceID + "/" + v["n"], "v": v["v"], "t": v["t"]})
+        if entries:
+            reqs.append(("", part, entries))
+        return reqs
+
+class Spool:
+    """
+    Values that could not be sent, oldest first. Up to memoryLimit samples are
+    held in memory; beyond that, and at shutdown, they go to an SQLite WAL file
+    so that they survive an outage or a restart. Once anything has been
+    spilled to disk, new entries also go to disk so that replay stays in order.
+    Only used from the reactor thread.
+    """
+    def __init__(self, path, memoryLimit):
+        self.memoryLimit = memoryLimit
+        self.memory = collections.deque()
+        self.memoryCount = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool (seq INTEGER PRIMARY KEY, device TEXT, body TEXT, count INTEGER)")
+        self.db.commit()
+        self.diskRows, self.diskCount, lastSeq = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(count), 0), COALESCE(MAX(seq), 0) FROM spool").fetchone()
+        self.seq = lastSeq + 1
+        if self.diskRows:
+            logging.info("%s Spool has %s unsent values from a previous run", ModuleName, self.diskCount)
+
+    def __len__(self):
+        """ Number of samples waiting """
+        return self.memoryCount + self.diskCount
+
+    def push(self, deviceID, values):
+        if not self.diskRows and self.memoryCount + len(values) <= self.memoryLimit:
+            self.memory.append((self.seq, deviceID, values))
+            self.memoryCount += len(values)
+        else:
+            self.write([(self.seq, deviceID, values)])
+        self.seq += 1
+
+    def write(self, entries):
+        self.db.executemany("INSERT INTO spool (seq, device, body, count) VALUES (?, ?, ?, ?)",
+                            [(seq, deviceID, json.dumps(values), len(values)) for seq, deviceID, values in entries])
+        self.db.commit()
+        self.diskRows += len(entries)
+        self.diskCount += sum(len(values) for seq, deviceID, values in entries)
+
+    def peek(self):
+        """ The oldest entry as (seq, deviceID, values), or None """
+        if self.memory:
+            return self.memory[0]
+        if self.diskRows:
+            seq, deviceID, body = self.db.execute("SELECT seq, device, body FROM spool ORDER BY seq LIMIT 1").fetchone()
+            return seq, deviceID, json.loads(body)
+        return None
+
+    def ack(self, seq):
+        """ The entry has been sent, so it can be dropped """
+        if self.memory and self.memory[0][0] == seq:
+            self.memoryCount -= len(self.memory.popleft()[2])
+            return
+        row = self.db.execute("SELECT count FROM spool WHERE seq = ?", (seq,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM spool WHERE seq = ?", (seq,))
+            self.db.commit()
+            self.diskRows -= 1
+            self.diskCount -= row[0]
+            if not self.diskRows:
+                self.compact()
+
+    def compact(self):
+        try:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.execute("VACUUM")
+        except Exception as ex:
+            logging.warning("%s Spool compact failed: %s %s", ModuleName, type(ex), str(ex.args))
+
+    def close(self):
+        if self.memory:
+            self.write(list(self.memory))
+            self.memory.clear()
+            self.memoryCount = 0
+        self.db.close()
+
+class EndpointHealth:
+    """
+    Retry backoff and circuit breaker for an upload endpoint. After
+    threshold consecutive failures the circuit opens and nothing is sent.
+    When the backoff expires a single probe is let through (half open): if it
+    succeeds the circuit closes, otherwise it opens again for longer.
+    """
+    def __init__(self, threshold, baseDelay, maxDelay):
+        self.threshold = threshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.state = "closed"
+        self.failures = 0
+
+    def success(self):
+        if self.state != "closed":
+            logging.info("%s Upload endpoint recovered after %s failures", ModuleName, self.failures)
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            if self.state == "closed":
+                logging.warning("%s Upload endpoint failing, circuit open", ModuleName)
+            self.state = "open"
+
+    def probe(self):
+        """ Called when the backoff expires """
+        if self.state == "open":
+            self.state = "half_open"
+
+    def delay(self):
+        """ Exponential backoff with equal jitter """
+        backoff = min(self.maxDelay, self.baseDelay * 2 ** min(max(self.failures - 1, 0), 30))
+        return backoff/2 + random.uniform(0, backoff/2)
+
+class UploadJob:
+    """
+    One POST. seq is set when the values are being replayed from the spool.
+    body is the encoded values if they have already been encoded.
+    """
+    def __init__(self, url, batch, values, seq=None, body=None):
+        self.url = url
+        self.batch = batch
+        self.values = values
+        self.seq = seq
+        self.body = body
+        self.bytes = 0
+        self.started = 0.0
+        self.duration = 0.0
+
+    def merge(self, job):
+        # New lists and a new batch, as sinks with the same format share them
+        self.values = self.values + job.values
+        self.body = None
+        self.batch = dict(self.batch)
+        for deviceID, values in job.batch.items():
+            if deviceID in self.batch:
+                self.batch[deviceID] = self.batch[deviceID] + values
+            else:
+                self.batch[deviceID] = values
+
+class UploadQueue:
+    """
+    Bounded queue of UploadJobs shared by the upload engines. When it is full
+    a new job is handled according to policy:
+        coalesce: merged into a queued job for the same URL (spilled if none)
+        spill: handed back to the DataManager to be spooled
+        drop_oldest: the oldest queued job is discarded to make room (the
+                     new one is spilled if they are all being replayed)
+    A replay job is never refused and goes to the front of the queue. Jobs
+    taken from the queue are in sending until their result is in.
+    """
+    def __init__(self, sink, queueSize, policy):
+        self.sink = sink
+        self.queueSize = queueSize
+        self.policy = policy
+        self.jobs = collections.deque()
+        self.sending = set()
+        self.dropped = 0
+
+    def enqueue(self, job):
+        """ Returns True if there is a new job in the queue """
+        if job.seq is not None:
+            self.jobs.appendleft(job)
+        elif len(self.jobs) < self.queueSize:
+            self.jobs.append(job)
+        elif self.policy == "drop_oldest":
+            for queued in self.jobs:
+                if queued.seq is None:
+                    self.jobs.remove(queued)
+                    self.dropped += len(queued.values)
+                    logging.warning("%s Upload queue full, dropped %s values", ModuleName, len(queued.values))
+                    self.jobs.append(job)
+                    break
+            else:
+                logging.debug("%s Upload queue full of replays, spooling %s values", ModuleName, len(job.values))
+                self.sink.spoolBatch(job.batch)
+                return False
+        else:
+            if self.policy == "coalesce":
+                for queued in reversed(self.jobs):
+                    if queued.seq is None and queued.url == job.url:
+                        queued.merge(job)
+                        return False
+            logging.debug("%s Upload queue full, spooling %s values", ModuleName, len(job.values))
+            self.sink.spoolBatch(job.batch)
+            return False
+        return True
+
+class Uploader(UploadQueue):
+    """
+    A fixed number of upload threads of our own, so that slow HTTP never ties
+    up the reactor thread pool that cbcommslib uses.
+    """
+    def __init__(self, sink, workers, queueSize, policy):
+        UploadQueue.__init__(self, sink, queueSize, policy)
+        self.cond = threading.Condition()
+        self.running = True
+        for w in range(workers):
+            t = threading.Thread(target=self.work, name="eew_upload_" + sink.name + "_" + str(w))
+            t.daemon = True
+            t.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def submit(self, job):
+        with self.cond:
+            if self.enqueue(job):
+                self.cond.notify()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                job = self.jobs.popleft()
+                self.sending.add(job)
+            self.sink.sendThread(job)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+class AsyncUploader(UploadQueue):
+    """
+    Non-blocking alternative to Uploader using Twisted's HTTP client, so no
+    threads are involved. At most connections requests are in flight over a
+    persistent connection pool; everything else waits in the queue. Results
+    are handled directly on the reactor thread.
+    """
+    def __init__(self, sink, connections, queueSize, policy):
+        UploadQueue.__init__(self, sink, queueSize, policy)
+        self.connections = connections
+        self.inFlight = 0
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = connections
+        self.agent = Agent(reactor, connectTimeout=float(config["http_connect_timeout"]), pool=self.pool)
+        self.headers = {}
+        if sink.key:
+            self.headers[b"Authorization"] = [b"Basic " + base64.b64encode((sink.key + ":").encode("utf-8"))]
+        for header, value in sink.encoder.headers.items():
+            self.headers[header.encode("utf-8")] = [value.encode("utf-8")]
+        reactor.addSystemEventTrigger('before', 'shutdown', self.pool.closeCachedConnections)
+
+    def submit(self, job):
+        if self.enqueue(job):
+            self.pump()
+
+    def pump(self):
+        while self.jobs and self.inFlight < self.connections:
+            self.send(self.jobs.popleft())
+
+    def send(self, job):
+        self.inFlight += 1
+        self.sending.add(job)
+        logging.debug("%s sendValues, url: %s length: %s", ModuleName, job.url, str(len(job.values)))
+        job.started = time.time()
+        try:
+            body = self.sink.encode(job)
+            job.bytes = len(body)
+            d = self.agent.request(b"POST", job.url.encode("utf-8"), Headers(self.headers),
+                                   FileBodyProducer(BytesIO(body)))
+        except Exception as ex:
+            logging.warning("%s Upload to %s failed: %s %s", ModuleName, self.sink.name, type(ex), str(ex.args))
+            reactor.callLater(0, self.onDone, False, job)
+            return
+        d.addCallback(self.onResponse)
+        d.addTimeout(float(config["http_read_timeout"]), reactor)
+        d.addCallbacks(self.onSuccess, self.onFailure)
+        d.addBoth(self.onDone, job)
+
+    def onResponse(self, response):
+        # The body must be read for the connection to go back in the pool
+        d = readBody(response)
+        d.addCallback(lambda body: response.code)
+        return d
+
+    def onSuccess(self, status):
+        if status != 200:
+            logging.debug("%s sendValues failed, status: %s", ModuleName, status)
+        return status == 200
+
+    def onFailure(self, failure):
+        logging.debug("%s sendValues exception: %s", ModuleName, failure.getErrorMessage())
+        return False
+
+    def onDone(self, ok, job):
+        job.duration = time.time() - job.started
+        self.inFlight -= 1
+        self.sink.onResult(job, ok)
+        self.pump()
+
+class Sink:
+    """
+    One destination for uploads, with its own queue, spool, retry backoff and
+    circuit breaker. endpoint decides how a batch is split into requests and
+    encoder how they are serialized; sinks with the same format are handed
+    the same encoded bytes by DataManager.post. Subclasses provide
+    deliver(job), called in an upload thread, which returns True if the
+    values got there.
+    """
+    def __init__(self, name, baseurl, endpoint, encoder, metrics):
+        self.name = name
+        self.baseurl = baseurl
+        self.endpoint = endpoint
+        self.encoder = encoder
+        self.metrics = metrics
+        self.format = endpoint.key + (encoder.encoding, encoder.gzip)
+        # The first sink keeps the spool file from before there were several
+        spoolFile = "eew_app_spool.db" if name == "geras" else "eew_app_spool_" + name + ".db"
+        self.spool = Spool(CB_CONFIG_DIR + spoolFile, int(config["spool_memory_limit"]))
+        self.health = EndpointHealth(int(config["breaker_threshold"]), float(config["retry_base_delay"]), float(config["retry_max_delay"]))
+        self.uploader = self.makeUploader()
+        self.replaying = False
+        self.replayTimer = None
+        self.closing = None
+        if len(self.spool):
+            self.replayTimer = reactor.callLater(config["send_delay"], self.replay)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def makeUploader(self):
+        return Uploader(self, int(config["upload_workers"]), int(config["upload_queue_size"]), config["upload_queue_policy"])
+
+    def close(self):
+        """
+        Anything still queued at shutdown is spooled for the next run. Uploads
+        in flight are given up to shutdown_upload_timeout to finish; shutdown
+        waits on the Deferred returned. Those that don't finish are spooled
+        too, so they may be sent twice rather than not at all.
+        """
+        for job in list(self.uploader.jobs):
+            if job.seq is None:
+                self.spoolBatch(job.batch)
+        self.uploader.jobs.clear()
+        if self.replayTimer is not None:
+            self.replayTimer.cancel()
+            self.replayTimer = None
+        if not self.uploader.sending:
+            self.spool.close()
+            return None
+        self.closing = defer.Deferred()
+        self.closeTimer = reactor.callLater(float(config["shutdown_upload_timeout"]), self.closed)
+        return self.closing
+
+    def closed(self):
+        """ Uploads in flight at shutdown are done, or out of time """
+        if self.closeTimer.active():
+            self.closeTimer.cancel()
+        for job in list(self.uploader.sending):
+            if job.seq is None:
+                self.spoolBatch(job.batch)
+        self.uploader.sending.clear()
+        self.spool.close()
+        closing = self.closing
+        self.closing = None
+        closing.callback(None)
+
+    def encode(self, job):
+        if job.body is None:
+            job.body = self.encoder.encode(job.values)
+        return job.body
+
+    def sendThread(self, job):
+        """ Called in an Uploader thread """
+        job.started = time.time()
+        try:
+            ok = self.deliver(job)
+        except Exception as ex:
+            # Reported as a failure so that the values are spooled, and the thread carries on
+            logging.warning("%s Upload to %s failed: %s %s", ModuleName, self.name, type(ex), str(ex.args))
+            ok = False
+        job.duration = time.time() - job.started
+        reactor.callFromThread(self.onResult, job, ok)
+
+    def onResult(self, job, ok):
+        if job not in self.uploader.sending:
+            # Already spooled, as shutdown ran out of time waiting for it
+            return
+        self.uploader.sending.discard(job)
+        self.metrics.upload(ok, job.duration, job.bytes)
+        if ok:
+            if job.seq is None:
+                self.onSent()
+            else:
+                self.onReplayed(job.seq)
+        elif job.seq is None:
+            # On error, spool the values that weren't sent ready to be sent again
+            self.onSendFailed(job.batch)
+        else:
+            self.onReplayFailed()
+        if self.closing is not None and not self.uploader.sending:
+            self.closed()
+
+    def onSent(self):
+        self.health.success()
+        # Connectivity is back, so start on anything spooled straight away
+        if len(self.spool) and not self.replaying:
+            if self.replayTimer is not None:
+                self.replayTimer.cancel()
+            self.replay()
+
+    def onSendFailed(self, batch):
+        self.health.failure()
+        self.spoolBatch(batch)
+        self.scheduleRetry()
+
+    def spoolBatch(self, batch):
+        for deviceID, values in batch.items():
+            self.spool.push(deviceID, values)
+
+    def scheduleRetry(self):
+        if not self.replaying and self.replayTimer is None and self.closing is None:
+            self.replayTimer = reactor.callLater(self.health.delay(), self.retry)
 
-    def sendValuesThread(self, values, deviceID):
-        url = self.baseurl + deviceID
+    def retry(self):
+        self.replayTimer = None
+        self.health.probe()
+        self.replay()
+
+    def replay(self):
+        """ Sends spooled values one entry at a time, oldest first """
+        self.replayTimer = None
+        if self.closing is not None:
+            self.replaying = False
+            return
+        entry = self.spool.peek()
+        if entry is None:
+            self.replaying = False
+            return
+        self.replaying = True
+        seq, deviceID, values = entry
+        path, part, entries = self.endpoint.split({deviceID: values})[0]
+        self.uploader.submit(UploadJob(self.baseurl + path, part, entries, seq))
+
+    def onReplayed(self, seq):
+        self.health.success()
+        self.spool.ack(seq)
+        self.replay()
+
+    def onReplayFailed(self):
+        self.health.failure()
+        self.replaying = False
+        self.scheduleRetry()
+
+    def post(self, requests):
+        """ requests are (path, batch part, values, body) from DataManager.post """
+        for path, part, values, body in requests:
+            self.uploader.submit(UploadJob(self.baseurl + path, part, values, body=body))
+
+class HttpSink(Sink):
+    """ POSTs to Geras, or anything else that takes the same requests """
+    def __init__(self, name, baseurl, endpoint, encoder, metrics, key):
+        self.key = key
+        self.sessions = {}
+        self.sessionLock = threading.Lock()
+        Sink.__init__(self, name, baseurl, endpoint, encoder, metrics)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.closeSessions)
+
+    def makeUploader(self):
+        if config["upload_engine"] == "async":
+            return AsyncUploader(self, int(config["http_pool_size"]), int(config["upload_queue_size"]), config["upload_queue_policy"])
+        return Sink.makeUploader(self)
+
+    def getSession(self, baseurl):
+        """ Keep-alive sessions are pooled per base URL and shared by the send threads """
+        with self.sessionLock:
+            session = self.sessions.get(baseurl)
+            if session is None:
+                session = requests.Session()
+                poolSize = max(int(config["http_pool_size"]), int(config["upload_workers"]))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if self.key:
+                    session.auth = (self.key, '')
+                session.headers.update(self.encoder.headers)
+                self.sessions[baseurl] = session
+            return session
+
+    def closeSessions(self):
+        with self.sessionLock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+    def deliver(self, job):
         status = 0
-        logging.debug("%s sendValues, device: %s length: %s", ModuleName, deviceID, str(len(values)))
-        headers = {'Content-Type': 'application/json'}
+        logging.debug("%s sendValues, url: %s length: %s", ModuleName, job.url, str(len(job.values)))
+        timeout = (float(config["http_connect_timeout"]), float(config["http_read_timeout"]))
+        body = self.encode(job)
+        job.bytes = len(body)
         try:
-            r = requests.post(url, auth=(config["geras_key"], ''), data=json.dumps({"e": values}), headers=headers)
+            r = self.getSession(self.baseurl).post(job.url, data=body, timeout=timeout)
             status = r.status_code
-            success = True
-        except:
-            success = False
-        if status !=200 or not success:
+        except Exception as ex:
+            logging.debug("%s sendValues exception: %s %s", ModuleName, type(ex), str(ex.args))
+        if status != 200:
             logging.debug("%s sendValues failed, status: %s", ModuleName, status)
-            # On error, store the values that weren't sent ready to be sent again
-            reactor.callFromThread(self.storeValues, values, deviceID)
-
-    def sendValues(self, deviceID):
-        values = self.s[deviceID]
-        # Call in thread as it may take a second or two
-        self.waiting.remove(deviceID)
-        del self.s[deviceID]
-        reactor.callInThread(self.sendValuesThread, values, deviceID)
-
-    def storeValues(self, values, deviceID):
-        if not deviceID in self.s:
-            self.s[deviceID] = values
-        else:
-            self.s[deviceID].append(values)
-        if not deviceID in self.waiting:
-            reactor.callLater(config["send_delay"], self.sendValues, deviceID)
-            self.waiting.append(deviceID)
-
-    def storeAccel(self, deviceID, timeStamp, a):
-        values = [
-                  {"n":"accel_x", "v":a[0], "t":timeStamp},
-                  {"n":"accel_y", "v":a[1], "t":timeStamp},
-                  {"n":"accel_z", "v":a[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeIrTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"ir_temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeHumidity(self, deviceID, timeStamp, h):
-        values = [
-                  {"n":"humidity", "v":h, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeButtons(self, deviceID, timeStamp, buttons):
-        values = [
-                  {"n":"left_button", "v":buttons["leftButton"], "t":timeStamp},
-                  {"n":"right_button", "v":buttons["rightButton"], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeGyro(self, deviceID, timeStamp, gyro):
-        values = [
-                  {"n":"gyro_x", "v":gyro[0], "t":timeStamp},
-                  {"n":"gyro_y", "v":gyro[1], "t":timeStamp},
-                  {"n":"gyro_z", "v":gyro[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeMagnet(self, deviceID, timeStamp, magnet):
-        values = [
-                  {"n":"magnet_x", "v":magnet[0], "t":timeStamp},
-                  {"n":"magnet_y", "v":magnet[1], "t":timeStamp},
-                  {"n":"magnet_z", "v":magnet[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeBinary(self, deviceID, timeStamp, b):
-        values = [
-                  {"n":"binary", "v":b, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeLuminance(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"luminance", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storePower(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"power", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeBattery(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"battery", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeConnected(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"connected", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-class Accelerometer:
-    def __init__(self, id):
-        self.previous = [0.0, 0.0, 0.0]
-        self.id = id
+            return False
+        return True
 
-    def processAccel(self, resp):
-        accel = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"]
-        event = False
-        for a in range(3):
-            if abs(accel[a] - self.previous[a]) > config["accel_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeAccel(self.id, timeStamp, accel)
-            self.previous = accel
-
-class TemperatureMeasure():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        # self.mode is either regular or on_change
-        self.mode = "on_change"
-        self.minChange = 0.2
-        self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
-        self.powerTemp = 0.0
-
-    def processTemp (self, resp):
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
-        else:
-            if abs(temp-self.powerTemp) >= config["temp_min_change"]:
-                self.dm.storeTemp(self.id, timeStamp, temp) 
-                self.powerTemp = temp
-
-class IrTemperatureMeasure():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        # self.mode is either regular or on_change
-        self.mode = "on_change"
-        self.minChange = 0.2
-        self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
-        self.powerTemp = 0.0
-
-    def processIrTemp (self, resp):
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeIrTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
+class FileSink(Sink):
+    """
+    Local archive: each request body is appended to <directory>/eew-<n>.json,
+    one JSON document per line, or to eew-<n>.json.gz as a gzip member (so the
+    file as a whole decompresses with zcat). A new file is started every
+    fileSize bytes and only the newest files are kept, all if files is 0.
+    """
+    def __init__(self, name, directory, endpoint, encoder, metrics, fileSize, files):
+        self.directory = directory
+        self.fileSize = fileSize
+        self.files = files
+        self.suffix = ".json.gz" if encoder.gzip else ".json"
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = self.archiveFiles()
+        self.number = int(os.path.basename(existing[-1])[4:-len(self.suffix)]) if existing else 0
+        Sink.__init__(self, name, "", endpoint, encoder, metrics)
+
+    def makeUploader(self):
+        # One writer, so that requests are archived in order
+        return Uploader(self, 1, int(config["upload_queue_size"]), config["upload_queue_policy"])
+
+    def archiveFiles(self):
+        return sorted(os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                      if f.startswith("eew-") and f.endswith(self.suffix))
+
+    def deliver(self, job):
+        body = self.encode(job)
+        job.bytes = len(body)
+        path = os.path.join(self.directory, "eew-%06d%s" % (self.number, self.suffix))
+        try:
+            if os.path.exists(path) and os.path.getsize(path) >= self.fileSize:
+                self.number += 1
+                path = os.path.join(self.directory, "eew-%06d%s" % (self.number, self.suffix))
+                if self.files:
+                    for old in self.archiveFiles()[:-(self.files - 1) or None]:
+                        os.remove(old)
+            with open(path, "ab") as f:
+                f.write(body if self.encoder.gzip else body + b"\n")
+        except Exception as ex:
+            logging.warning("%s Archive write failed: %s %s", ModuleName, type(ex), str(ex.args))
+            return False
+        return True
+
+def makeSink(spec, bridge_id, metrics):
+    """
+    A sink from one entry of config["sinks"]. Anything not given in the entry
+    comes from the top level settings. Entries have "name", "type" and:
+        http: "url" (bridge ID is appended), "key" ("" for no auth), "bulk",
+              "bulk_url", "max_entries", "encoding", "gzip"
+        file: "path" (relative to the config directory), "file_size",
+              "files", "max_entries", "encoding", "gzip"
+    """
+    def setting(key, default):
+        value = spec.get(key, default)
+        if hasattr(value, "lower") and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        return value
+    encoder = PayloadEncoder(setting("encoding", config["payload_encoding"]), setting("gzip", config["payload_gzip"] is True))
+    maxEntries = int(setting("max_entries", config["bulk_max_entries"]))
+    if spec["type"] == "file":
+        return FileSink(spec["name"], os.path.join(CB_CONFIG_DIR, setting("path", "archive")), BulkEndpoint(maxEntries),
+                        encoder, metrics, int(setting("file_size", 16777216)), int(setting("files", 0)))
+    baseurl = setting("url", config["geras_url"]) + bridge_id + "/"
+    if setting("bulk", config["batch_upload"] is True):
+        # Geras accepts names relative to the URL posted to, so by default
+        # the bulk endpoint is the bridge series itself
+        baseurl = setting("bulk_url", "" if "url" in spec else config["bulk_url"]) or baseurl
+        endpoint = BulkEndpoint(maxEntries)
+    else:
+        endpoint = GerasEndpoint()
+    return HttpSink(spec["name"], baseurl, endpoint, encoder, metrics, setting("key", config["geras_key"]))
+
+class SeriesBuffer:
+    """
+    Samples of one series waiting to be sent, as timestamp and value columns.
+    Values are held as doubles; those of integer series, such as binary,
+    connected and button states, are sent as ints.
+    """
+    __slots__ = ("name", "integer", "t", "v")
+
+    def __init__(self, name, integer=False):
+        self.name = name
+        self.integer = integer
+        self.t = array('d')
+        self.v = array('d')
+
+    def __len__(self):
+        return len(self.t)
+
+    def append(self, timeStamp, v):
+        # The value first, so that one that is not a number leaves nothing behind
+        self.v.append(v)
+        self.t.append(timeStamp)
+
+    def pop(self):
+        self.v.pop()
+        self.t.pop()
+
+    def entries(self):
+        name = self.name
+        if self.integer:
+            return [{"n": name, "v": int(v), "t": t} for t, v in zip(self.t, self.v)]
+        return [{"n": name, "v": v, "t": t} for t, v in zip(self.t, self.v)]
+
+class RingBuffer:
+    """ The last size samples of one series, overwriting the oldest """
+    __slots__ = ("t", "v", "size", "next", "count")
+
+    def __init__(self, size):
+        self.t = array('d', [0.0])*size
+        self.v = array('d', [0.0])*size
+        self.size = size
+        self.next = 0
+        self.count = 0
+
+    def append(self, timeStamp, v):
+        i = self.next
+        self.t[i] = timeStamp
+        self.v[i] = v
+        self.next = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def latest(self):
+        if not self.count:
+            return None
+        i = self.next - 1
+        return [self.t[i], self.v[i]]
+
+    def samples(self, start=None, end=None):
+        """ [t, v] pairs, oldest first, with start <= t <= end """
+        first = (self.next - self.count) % self.size
+        order = [(first + k) % self.size for k in range(self.count)]
+        t = self.t
+        v = self.v
+        return [[t[i], v[i]] for i in order
+                if (start is None or t[i] >= start) and (end is None or t[i] <= end)]
+
+    def downsample(self, start, end, points):
+        """ [t, mean, min, max] for each of points equal time buckets with data """
+        samples = self.samples(start, end)
+        if not samples or points < 1:
+            return []
+        start = samples[0][0] if start is None else start
+        end = samples[-1][0] if end is None else end
+        width = (end - start)/points or 1.0
+        buckets = collections.OrderedDict()
+        for timeStamp, v in samples:
+            bucket = buckets.setdefault(min(int((timeStamp - start)/width), points - 1), [])
+            bucket.append(v)
+        return [[start + b*width, sum(vs)/len(vs), min(vs), max(vs)] for b, vs in buckets.items()]
+
+class History:
+    """
+    Recent values of every series, as received ("raw") and as passed on for
+    upload ("uploaded"), kept in memory for local queries. See App.onQuery.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buffers = {"raw": {}, "uploaded": {}}
+        self.groups = {"raw": {}, "uploaded": {}}
+
+    def store(self, kind, deviceID, timeStamp, names, values):
+        # The buffers for a device's names tuple are looked up once, not per name
+        group = self.groups[kind].get((deviceID, names))
+        if group is None:
+            buffers = self.buffers[kind]
+            for name in names:
+                if (deviceID, name) not in buffers:
+                    buffers[(deviceID, name)] = RingBuffer(self.size)
+            group = self.groups[kind][(deviceID, names)] = [buffers[(deviceID, name)] for name in names]
+        if len(group) == 1:
+            group[0].append(timeStamp, values[0])
         else:
-            if abs(temp-self.powerTemp) >= config["irtemp_min_change"]:
-                self.dm.storeIrTemp(self.id, timeStamp, temp) 
-                self.powerTemp = temp
+            for buf, v in zip(group, values):
+                buf.append(timeStamp, v)
 
-class Buttons():
-    def __init__(self, id):
-        self.id = id
+    def series(self):
+        """ {device: [series, ...]} for everything held """
+        devices = {}
+        for kind in self.buffers:
+            for deviceID, name in self.buffers[kind]:
+                names = devices.setdefault(deviceID, [])
+                if name not in names:
+                    names.append(name)
+        return devices
 
-    def processButtons(self, resp):
-        timeStamp = resp["timeStamp"] 
-        buttons = resp["data"]
-        self.dm.storeButtons(self.id, timeStamp, buttons)
+    def get(self, kind, deviceID, name):
+        return self.buffers.get(kind, {}).get((deviceID, name))
 
-class Gyro():
-    def __init__(self, id):
-        self.id = id
-        self.previous = [0.0, 0.0, 0.0]
-
-    def processGyro(self, resp):
-        gyro = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
-        for a in range(3):
-            if abs(gyro[a] - self.previous[a]) > config["gyro_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeGyro(self.id, timeStamp, gyro)
-            self.previous = gyro
-
-class Magnet():
-    def __init__(self, id):
-        self.id = id
-        self.previous = [0.0, 0.0, 0.0]
-
-    def processMagnet(self, resp):
-        mag = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
-        for a in range(3):
-            if abs(mag[a] - self.previous[a]) > config["magnet_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeMagnet(self.id, timeStamp, mag)
-            self.previous = mag
-
-class Humid():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0.0
+class Metrics:
+    """
+    Counters for the periodic stats report. The sample and upload paths only
+    do plain increments; rates and ratios are worked out when reporting.
+    Dropped samples are counted by cause: unrouted (not for any processor)
+    and ingest_queue (the queue was full). Each sink reports the values its
+    upload queue dropped.
+    """
+    def __init__(self):
+        self.latencyBuckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+        self.reset()
 
-    def processHumidity (self, resp):
-        h = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(h-self.previous) >= config["humidity_min_change"]:
-            self.dm.storeHumidity(self.id, timeStamp, h) 
-            self.previous = h
+    def reset(self):
+        self.started = time.time()
+        self.ingested = {}
+        self.passed = {}
+        self.unrouted = 0
+        self.overflowed = 0
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+        self.latency = [0]*(len(self.latencyBuckets) + 1)
 
-class Binary():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
+    def upload(self, ok, duration, nbytes):
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+        self.bytes += nbytes
+        self.latency[bisect.bisect_left(self.latencyBuckets, duration)] += 1
+
+    def report(self, dm):
+        """ Returns the stats since the last report and starts counting afresh """
+        now = time.time()
+        interval = now - self.started
+        ingest = {}
+        for characteristic, count in self.ingested.items():
+            passed = self.passed.get(characteristic, 0)
+            ingest[characteristic] = {"messages": count,
+                                      "rate": round(count/interval, 3),
+                                      "passed": passed,
+                                      "suppressed": count - passed,
+                                      "pass_ratio": round(float(passed)/count, 3)}
+        latency = dict(("<=" + str(b), n) for b, n in zip(self.latencyBuckets, self.latency))
+        latency[">" + str(self.latencyBuckets[-1])] = self.latency[-1]
+        stats = {"time": now,
+                 "interval": round(interval, 1),
+                 "ingest": ingest,
+                 "dropped": {"unrouted": self.unrouted,
+                             "ingest_queue": self.overflowed},
+                 "uploads": {"requests": self.requests,
+                             "failures": self.failures,
+                             "bytes": self.bytes,
+                             "latency": latency}}
+        if dm:
+            stats["buffered"] = dict((deviceID, sum(len(buf) for buf in series.values()))
+                                     for deviceID, series in dm.s.items())
+            stats["waiting"] = len(dm.units)
+            stats["sinks"] = dict((sink.name, {"spooled": len(sink.spool),
+                                               "upload_queue": len(sink.uploader.jobs),
+                                               "dropped": sink.uploader.dropped,
+                                               "circuit": sink.health.state})
+                                  for sink in dm.sinks)
+            for sink in dm.sinks:
+                sink.uploader.dropped = 0
+            stats["shedding"] = dm.backpressure.level
+        self.reset()
+        return stats
+
+class Backpressure:
+    """
+    Watches the upload backlog (buffered, queued and spooled samples) and the
+    age of the oldest spooled sample, for whichever sink is furthest behind, and sets a shedding level:
+        0: everything at full fidelity
+        1: motion sensor deadbands widened by backpressure_deadband_factor
+        2: as 1, and scalar deadbands and compression errors widened by it too
+    Binary and connected transitions are never shed. A level is entered when
+    either backpressure_samples or backpressure_age for it is reached, and left
+    once both are below half of it. Listeners are called with the new level.
+    """
+    def __init__(self, dm):
+        self.dm = dm
+        self.samples = [float(n) for n in config["backpressure_samples"]]
+        self.ages = [float(a) for a in config["backpressure_age"]]
+        self.level = 0
+        self.listeners = []
+        self.loop = task.LoopingCall(self.check)
+        self.loop.start(float(config["backpressure_interval"]), now=False)
+
+    def backlog(self):
+        """ Buffered samples plus those queued and spooled for the furthest behind sink """
+        buffered = sum(len(buf) for series in self.dm.s.values() for buf in series.values())
+        waiting = 0
+        age = 0.0
+        for sink in self.dm.sinks:
+            queued = sum(len(job.values) for job in list(sink.uploader.jobs))
+            waiting = max(waiting, queued + len(sink.spool))
+            entry = sink.spool.peek()
+            if entry and entry[2]:
+                age = max(age, time.time() - min(v["t"] for v in entry[2]))
+        return buffered + waiting, age
+
+    def check(self):
+        backlog, age = self.backlog()
+        level = self.level
+        while level < len(self.samples) and (backlog >= self.samples[level] or age >= self.ages[level]):
+            level += 1
+        if level == self.level:
+            while level > 0 and backlog < self.samples[level - 1]/2 and age < self.ages[level - 1]/2:
+                level -= 1
+        if level != self.level:
+            logging.warning("%s Upload backlog %s samples, oldest %ss: shedding level %s", ModuleName, backlog, int(age), level)
+            self.level = level
+            for listener in self.listeners:
+                listener(level)
+
+class FlushState:
+    """
+    When to send the samples pending for one flush unit: a device, or every
+    device in batch mode. deadline is the soonest any of them wants to go,
+    latest the longest any of them may wait. checked is the count when the
+    deadline was last put back for want of samples.
+    """
+    __slots__ = ("count", "first", "deadline", "latest", "timer", "checked")
+
+    def __init__(self, now):
+        self.count = 0
+        self.first = now
+        self.deadline = None
+        self.latest = None
+        self.timer = None
+        self.checked = None
+
+class ArrivalRate:
+    """
+    Samples per second arriving over the last window seconds, counted in
+    slots so that adding to it is constant work. Until a whole window has
+    passed the rate is over the time since it started, but at least a slot.
+    """
+    __slots__ = ("slot", "counts", "current", "started")
+    slots = 10
+
+    def __init__(self, window, now):
+        self.slot = window/self.slots
+        self.counts = [0]*self.slots
+        self.current = int(now/self.slot)
+        self.started = now
+
+    def advance(self, now):
+        current = int(now/self.slot)
+        for i in range(self.current + 1, min(current, self.current + self.slots) + 1):
+            self.counts[i % self.slots] = 0
+        if current > self.current:
+            self.current = current
 
-    def processBinary(self, resp):
-        timeStamp = resp["timeStamp"] 
-        b = resp["data"]
-        if b == "on":
-            bi = 1
+    def add(self, now, n):
+        self.advance(now)
+        self.counts[self.current % self.slots] += n
+
+    def rate(self, now):
+        self.advance(now)
+        span = min(now - self.started, self.slot*self.slots)
+        return sum(self.counts)/max(span, self.slot)
+
+class DataManager:
+    """
+    Managers data storage for all sensors. Samples are buffered per flush
+    unit and sent when the first of these happens:
+        flush_max_samples are pending, or about flush_max_bytes once encoded
+        the shortest latency class age among them has passed, as long as
+            flush_min_samples are pending
+        otherwise, once the rate samples are arriving at says
+            flush_min_samples will not arrive in time, or the longest age of
+            the class has passed
+    A latency class is [age, longest age]; series are given one by
+    latency_class, "normal" by default. An age of 0 sends at the end of the
+    current ingest tick. Arrival rates are kept per flush unit and latency
+    class over the last flush_rate_window seconds. Waiting for more samples
+    is put off by at least flush_min_wait, and only again if some have
+    arrived since the last time; otherwise the unit waits for its longest age.
+    """
+    def __init__(self, bridge_id, metrics, history):
+        self.metrics = metrics
+        self.history = history
+        self.s={}
+        self.units = {}
+        self.rates = {}
+        self.flushed = {}
+        self.flushListeners = []
+        self.stored = 0
+        self.batch = config["batch_upload"] is True
+        self.maxSamples = int(config["flush_max_samples"])
+        self.maxBytes = int(config["flush_max_bytes"])
+        self.minSamples = int(config["flush_min_samples"])
+        self.rateWindow = float(config["flush_rate_window"])
+        self.minWait = float(config["flush_min_wait"])
+        self.latency = tuple(float(a) for a in config["latency_classes"]["normal"])
+        self.bytesPerSample = 50.0
+        self.sinks = [makeSink(spec, bridge_id, metrics) for spec in config["sinks"]]
+        self.backpressure = Backpressure(self)
+
+    def post(self, batch):
+        """
+        Hands batch to every sink. It is split and encoded once for each
+        format in use, and sinks with the same format share the bytes. Sinks
+        that are down spool the values without encoding them.
+        """
+        encoded = {}
+        for sink in self.sinks:
+            if sink.health.state != "closed":
+                # Only the probe goes out until the endpoint has recovered
+                sink.spoolBatch(batch)
+                continue
+            requests = encoded.get(sink.format)
+            if requests is None:
+                requests = encoded[sink.format] = [(path, part, values, sink.encoder.encode(values))
+                                                   for path, part, values in sink.endpoint.split(batch)]
+                if requests:
+                    # For the size trigger, how big a sample is once it has been encoded
+                    path, part, values, body = requests[0]
+                    self.bytesPerSample = 0.8*self.bytesPerSample + 0.2*len(body)/max(len(values), 1)
+            sink.post(requests)
+
+    def entries(self, series):
+        """ JSON entries are only built when the buffered columns are flushed """
+        values = []
+        for buf in series.values():
+            values.extend(buf.entries())
+        return values
+
+    def flush(self, key=None):
+        """ Sends what is pending for a flush unit: a device, or everything in batch mode (key None) """
+        unit = self.units.pop(key, None)
+        if unit:
+            if unit.timer and unit.timer.active():
+                unit.timer.cancel()
+        if key is None:
+            pending = self.s
+            self.s = {}
+        elif key in self.s:
+            pending = {key: self.s.pop(key)}
         else:
-            bi = 0
-        if bi != self.previous:
-            self.dm.storeBinary(self.id, timeStamp-1.0, self.previous)
-            self.dm.storeBinary(self.id, timeStamp, bi)
-            self.previous = bi
-
-class Luminance():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
+            pending = {}
+        if pending:
+            self.post(dict((deviceID, self.entries(series)) for deviceID, series in pending.items()))
+            for deviceID, series in pending.items():
+                marks = self.flushed.setdefault(deviceID, {})
+                for name, buf in series.items():
+                    marks[name] = max(marks.get(name, float("-inf")), max(buf.t))
+            for listener in self.flushListeners:
+                listener(pending)
 
-    def processLuminance(self, resp):
-        v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["luminance_min_change"]:
-            self.dm.storeLuminance(self.id, timeStamp, v) 
-            self.previous = v
+    def snapshot(self):
+        """ Pending samples as {deviceID: {name: [times, values]}} """
+        return dict((deviceID, dict((name, [buf.t.tolist(), buf.v.tolist()]) for name, buf in series.items()))
+                    for deviceID, series in self.s.items())
+
+    def restore(self, buffers, flushed):
+        """
+        Samples that were pending at the last snapshot go with the next flush,
+        except those at or before the time each series was last flushed up to
+        (flushed, as from the snapshot), as they have been sent since
+        """
+        now = time.time()
+        for deviceID, marks in flushed.items():
+            self.flushed[deviceID] = dict(marks)
+        for deviceID, series in buffers.items():
+            marks = self.flushed.get(deviceID, {})
+            count = 0
+            for name, (t, v) in series.items():
+                mark = marks.get(name)
+                if mark is not None:
+                    v = [value for timeStamp, value in zip(t, v) if timeStamp > mark]
+                    t = [timeStamp for timeStamp in t if timeStamp > mark]
+                if not t:
+                    continue
+                pending = self.s.setdefault(deviceID, {})
+                if name not in pending:
+                    pending[name] = SeriesBuffer(name, name in INTEGER_SERIES)
+                pending[name].v.extend(v)
+                pending[name].t.extend(t)
+                count += len(t)
+            if not count:
+                continue
+            key = None if self.batch else deviceID
+            if key not in self.units:
+                unit = self.units[key] = FlushState(now)
+                unit.deadline = unit.latest = now + self.latency[0]
+                unit.timer = reactor.callLater(self.latency[0], self.onDeadline, key)
+            self.units[key].count += count
+
+    def onDeadline(self, key):
+        unit = self.units.get(key)
+        if unit is None:
+            return
+        unit.timer = None
+        now = time.time()
+        if unit.count < self.minSamples and now < unit.latest:
+            # Too small to be worth a request yet: wait for more, if they will come in time
+            wait = unit.latest - now
+            if unit.count != unit.checked:
+                rate = sum(r.rate(now) for r in self.rates.get(key, {}).values())
+                if rate:
+                    wait = min(wait, max((self.minSamples - unit.count)/rate, self.minWait))
+            unit.checked = unit.count
+            if wait > 0.01:
+                unit.deadline = now + wait
+                unit.timer = reactor.callLater(wait, self.onDeadline, key)
+                return
+        self.flush(key)
+
+    def storeValues(self, deviceID, timeStamp, names, values, latency=None):
+        """
+        latency is the series' [age, longest age], see DataManager. A sample
+        with a value that is not a number is dropped as a whole.
+        """
+        series = self.s.get(deviceID)
+        if series is None:
+            series = self.s[deviceID] = {}
+        appended = 0
+        try:
+            for name, v in zip(names, values):
+                buf = series.get(name)
+                if buf is None:
+                    buf = series[name] = SeriesBuffer(name, name in INTEGER_SERIES)
+                buf.append(timeStamp, v)
+                appended += 1
+        except TypeError:
+            for name in names[:appended]:
+                series[name].pop()
+            logging.warning("%s Dropped %s %s at %s: %s is not a number", ModuleName, deviceID, names, timeStamp,
+                            repr(values[appended]))
+            return
+        self.stored += 1
+        if self.history:
+            self.history.store("uploaded", deviceID, timeStamp, names, values)
+        key = None if self.batch else deviceID
+        now = time.time()
+        unit = self.units.get(key)
+        if unit is None:
+            unit = self.units[key] = FlushState(now)
+        unit.count += len(names)
+        latency = latency or self.latency
+        rates = self.rates.get(key)
+        if rates is None:
+            rates = self.rates[key] = {}
+        rate = rates.get(latency)
+        if rate is None:
+            rate = rates[latency] = ArrivalRate(self.rateWindow, now)
+        rate.add(now, len(names))
+        age, longest = latency
+        if unit.count >= self.maxSamples or unit.count*self.bytesPerSample >= self.maxBytes:
+            age = longest = 0.0
+        if unit.latest is None or now + longest < unit.latest:
+            unit.latest = now + longest
+        if unit.deadline is None or now + age < unit.deadline:
+            unit.deadline = now + age
+            if unit.timer is None:
+                unit.timer = reactor.callLater(age, self.onDeadline, key)
+            else:
+                unit.timer.reset(age)
+
+def decodeScalar(data):
+    return (data,)
+
+def decodeXYZ(data):
+    return (data["x"], data["y"], data["z"])
+
+def decodeOnOff(data):
+    return (1 if data == "on" else 0,)
+
+def decodeBool(data):
+    return (1 if data else 0,)
+
+def decodeButtons(data):
+    return (data["leftButton"], data["rightButton"])
+
+def encodeScalar(values):
+    return values[0]
+
+def encodeXYZ(values):
+    return {"x": values[0], "y": values[1], "z": values[2]}
+
+def encodeOnOff(values):
+    return "on" if values[0] else "off"
+
+def encodeBool(values):
+    return bool(values[0])
+
+def encodeButtons(values):
+    return {"leftButton": int(values[0]), "rightButton": int(values[1])}
+
+# The adaptor's data back from decoded values, for replaying recordings
+ENCODE = {decodeScalar: encodeScalar,
+          decodeXYZ: encodeXYZ,
+          decodeOnOff: encodeOnOff,
+          decodeBool: encodeBool,
+          decodeButtons: encodeButtons}
+
+class SeriesSpec:
+    """
+    How one characteristic is turned into series. detection is one of:
+        change: scalar deadband, sent when it moves by at least the threshold
+        change_any: 3-axis deadband, sent when any axis moves by more than it
+        step: as change, but if the last value sent is more than 2s old it is
+              repeated 1s before the new one, so that the series is a step
+        edge: every state transition, with the old state repeated 1s before
+        all: every sample
+    key is the prefix of the series' own config, e.g. <key>_min_change.
+    integer is True for states that are decoded to ints and sent as ints.
+    """
+    def __init__(self, characteristic, enable, names, decode, key, detection, intervalKey):
+        self.characteristic = characteristic
+        self.enable = enable
+        self.names = names
+        self.decode = decode
+        self.key = key
+        self.detection = detection
+        self.intervalKey = intervalKey
+        self.integer = decode in (decodeOnOff, decodeBool, decodeButtons)
+
+# Adding a sensor type only needs a row here
+SERIES = dict((spec.characteristic, spec) for spec in [
+    SeriesSpec("acceleration", "accel", ("accel_x", "accel_y", "accel_z"), decodeXYZ,
+               "accel", "change_any", "accel_polling_interval"),
+    SeriesSpec("gyro", "gyro", ("gyro_x", "gyro_y", "gyro_z"), decodeXYZ,
+               "gyro", "change_any", "gyro_polling_interval"),
+    SeriesSpec("magnetometer", "magnet", ("magnet_x", "magnet_y", "magnet_z"), decodeXYZ,
+               "magnet", "change_any", "magnet_polling_interval"),
+    SeriesSpec("temperature", "temperature", ("temperature",), decodeScalar,
+               "temp", "change", "slow_polling_interval"),
+    SeriesSpec("ir_temperature", "irtemperature", ("ir_temperature",), decodeScalar,
+               "irtemp", "change", "slow_polling_interval"),
+    SeriesSpec("humidity", "humidity", ("humidity",), decodeScalar,
+               "humidity", "change", "slow_polling_interval"),
+    SeriesSpec("luminance", "luminance", ("luminance",), decodeScalar,
+               "luminance", "change", None),
+    SeriesSpec("power", "power", ("power",), decodeScalar,
+               "power", "step", None),
+    SeriesSpec("battery", "battery", ("battery",), decodeScalar,
+               "battery", "change", None),
+    SeriesSpec("binary_sensor", "binary", ("binary",), decodeOnOff,
+               None, "edge", None),
+    SeriesSpec("connected", "connected", ("connected",), decodeBool,
+               None, "edge", None),
+    SeriesSpec("buttons", "buttons", ("left_button", "right_button"), decodeButtons,
+               None, "all", None)
+])
+
+# Series whose pending values are sent as ints, see SeriesBuffer
+INTEGER_SERIES = frozenset(name for spec in SERIES.values() if spec.integer for name in spec.names)
+
+# Recording format: device index, characteristic code, timestamp, three values.
+# Codes are positions in RECORD_CODES, so new characteristics go on the end.
+RECORD = struct.Struct("<HH4xd3d")
+RECORD_CODES = ("acceleration", "gyro", "magnetometer", "temperature", "ir_temperature", "humidity",
+                "luminance", "power", "battery", "binary_sensor", "connected", "buttons")
+if numpy:
+    RECORD_DTYPE = numpy.dtype([("device", "<u2"), ("code", "<u2"), ("pad", "V4"), ("t", "<f8"), ("v", "<f8", (3,))])
+NAN = float("nan")
+
+class Recorder:
+    """
+    Appends every raw sample to <record_dir>/eew-<n>.rec as a fixed-width
+    RECORD, unused values being NaN. devices.json maps the device index to
+    adaptor id and name. A new file is started every record_file_size bytes
+    and only the newest record_files are kept. Only used from the reactor thread.
+    """
+    def __init__(self, directory, idToName, fileSize, files):
+        self.directory = directory
+        self.idToName = idToName
+        self.fileSize = fileSize
+        self.files = files
+        self.codes = dict((characteristic, code) for code, characteristic in enumerate(RECORD_CODES))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.devices = recordingDevices(directory)
+        self.index = dict((device[0], i) for i, device in enumerate(self.devices))
+        existing = recordingFiles(directory)
+        self.number = int(os.path.basename(existing[-1])[4:-4]) + 1 if existing else 0
+        self.file = None
+        self.open()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def open(self):
+        self.file = open(os.path.join(self.directory, "eew-%06d.rec" % self.number), "ab")
+        self.number += 1
+        self.size = 0
+        for old in recordingFiles(self.directory)[:-self.files]:
+            os.remove(old)
+
+    def addDevice(self, deviceID):
+        self.index[deviceID] = len(self.devices)
+        self.devices.append([deviceID, self.idToName.get(deviceID, deviceID)])
+        path = os.path.join(self.directory, "devices.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.devices, f)
+        os.rename(path + ".tmp", path)
+        return self.index[deviceID]
+
+    def record(self, message):
+        """ A sample that cannot be packed is skipped; if the files cannot be written, recording stops """
+        if not self.file:
+            return
+        try:
+            characteristic = message["characteristic"]
+            values = SERIES[characteristic].decode(message["data"]) + (NAN, NAN, NAN)
+            fields = (self.codes[characteristic], message["timeStamp"], values[0], values[1], values[2])
+            device = self.index.get(message["id"])
+            record = RECORD.pack(device or 0, *fields)
+        except Exception as ex:
+            logging.debug("%s Not recording %s: %s %s", ModuleName, message, type(ex), str(ex.args))
+            return
+        try:
+            if device is None:
+                device = self.addDevice(message["id"])
+                record = RECORD.pack(device, *fields)
+            self.file.write(record)
+            self.size += RECORD.size
+            if self.size >= self.fileSize:
+                self.file.close()
+                self.open()
+        except Exception as ex:
+            logging.warning("%s Recording stopped: %s %s", ModuleName, type(ex), str(ex.args))
+            self.close()
+
+    def close(self):
+        if self.file:
+            try:
+                self.file.close()
+            except Exception as ex:
+                logging.warning("%s Could not close recording: %s %s", ModuleName, type(ex), str(ex.args))
+            self.file = None
+
+def recordingFiles(directory):
+    """ Recording files in directory, oldest first """
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if f.startswith("eew-") and f.endswith(".rec"))
+
+def recordingDevices(directory):
+    """ [adaptor id, name] for each device index """
+    try:
+        with open(os.path.join(directory, "devices.json")) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+def readRecording(path, devices):
+    """
+    Memory-maps a recording file and yields its samples as onAdaptorData
+    messages. A partial record at the end, from a crash, is ignored.
+    """
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        unpack = RECORD.unpack_from
+        specs = [SERIES[characteristic] for characteristic in RECORD_CODES]
+        end = len(data) - len(data) % RECORD.size
+        offset = 0
+        while offset < end:
+            device, code, timeStamp, a, b, c = unpack(data, offset)
+            offset += RECORD.size
+            spec = specs[code]
+            yield {"id": devices[device][0],
+                   "characteristic": spec.characteristic,
+                   "timeStamp": timeStamp,
+                   "data": ENCODE[spec.decode]((a, b, c))}
+    finally:
+        data.close()
+
+def recordingArray(path):
+    """ A recording file as a read-only NumPy structured array (see RECORD_DTYPE) """
+    count = os.path.getsize(path)//RECORD.size
+    if not count:
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    return numpy.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+
+class SeriesParams:
+    """ A series' settings, parsed from config once rather than looked up for every sample """
+    __slots__ = ("enabled", "threshold", "compressionError", "rollupInterval", "rollupAggregates", "pollingInterval",
+                 "latency")
+
+    def __init__(self, spec, c):
+        key = spec.key
+        self.enabled = c[spec.enable] is True
+        self.threshold = float(c[key + "_min_change"]) if key else 0.0
+        self.compressionError = float(c.get(key + "_compression_error", 0.0)) if key else 0.0
+        self.rollupInterval = float(c.get(key + "_rollup_interval", 0.0)) if key else 0.0
+        self.rollupAggregates = tuple(c.get(key + "_rollup_aggregates", c["rollup_aggregates"]) if key
+                                      else c["rollup_aggregates"])
+        self.pollingInterval = float(c[spec.intervalKey]) if spec.intervalKey else 0
+        latencyClass = c["latency_class"].get(spec.characteristic, "normal")
+        self.latency = tuple(float(a) for a in c["latency_classes"][latencyClass])
 
-class Power():
-    def __init__(self, id):
+def compileSeries(c):
+    """ Parameters for every characteristic, from config c """
+    return dict((characteristic, SeriesParams(spec, c)) for characteristic, spec in SERIES.items())
+
+def processorClass(spec, params):
+    """ Which processor a series gets with these parameters """
+    if spec.detection == "change_any" and config["motion_mode"] == "window" and numpy:
+        return MotionWindow
+    if spec.detection in ("change", "step"):
+        if params.rollupInterval > 0:
+            return Rollup
+        if params.compressionError > 0:
+            return SwingingDoor
+    return Detector
+
+class Detector:
+    """ Change detection for one characteristic of one device """
+    __slots__ = ("id", "dm", "names", "decode", "baseThreshold", "factor", "threshold", "latency", "previous",
+                 "previousTime", "process")
+
+    def __init__(self, id, spec, params, dm):
         self.id = id
-        self.previous = 0
+        self.dm = dm
+        self.names = spec.names
+        self.decode = spec.decode
+        self.factor = 1.0
+        self.configure(params)
+        self.previous = (0,) * len(spec.names)
         self.previousTime = time.time()
+        self.process = {"change": self.processChange,
+                        "change_any": self.processChangeAny,
+                        "step": self.processStep,
+                        "edge": self.processEdge,
+                        "all": self.processAll}[spec.detection]
 
-    def processPower(self, resp):
+    def processChange(self, resp):
+        # Scalar data, so there is nothing to decode
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["power_min_change"]:
+        if abs(v - self.previous[0]) >= self.threshold:
+            self.previous = (v,)
+            self.dm.storeValues(self.id, resp["timeStamp"], self.names, self.previous, self.latency)
+
+    def processChangeAny(self, resp):
+        values = self.decode(resp["data"])
+        p = self.previous
+        t = self.threshold
+        if abs(values[0] - p[0]) > t or abs(values[1] - p[1]) > t or abs(values[2] - p[2]) > t:
+            self.dm.storeValues(self.id, resp["timeStamp"], self.names, values, self.latency)
+            self.previous = values
+
+    def processStep(self, resp):
+        values = self.decode(resp["data"])
+        timeStamp = resp["timeStamp"]
+        if abs(values[0] - self.previous[0]) >= self.threshold:
             if timeStamp - self.previousTime > 2:
-                self.dm.storePower(self.id, timeStamp-1.0, self.previous)
-            self.dm.storePower(self.id, timeStamp, v) 
-            self.previous = v
+                self.dm.storeValues(self.id, timeStamp-1.0, self.names, self.previous, self.latency)
+            self.dm.storeValues(self.id, timeStamp, self.names, values, self.latency)
+            self.previous = values
             self.previousTime = timeStamp
 
-class Battery():
-    def __init__(self, id):
+    def processEdge(self, resp):
+        values = self.decode(resp["data"])
+        if values != self.previous:
+            timeStamp = resp["timeStamp"]
+            self.dm.storeValues(self.id, timeStamp-1.0, self.names, self.previous, self.latency)
+            self.dm.storeValues(self.id, timeStamp, self.names, values, self.latency)
+            self.previous = values
+
+    def processAll(self, resp):
+        self.dm.storeValues(self.id, resp["timeStamp"], self.names, self.decode(resp["data"]), self.latency)
+
+    def snapshot(self):
+        return [list(self.previous), self.previousTime]
+
+    def restore(self, state):
+        self.previous = tuple(state[0])
+        self.previousTime = state[1]
+
+    def configure(self, params):
+        """ Returns False if the new parameters need a new processor """
+        self.baseThreshold = params.threshold
+        self.threshold = self.baseThreshold*self.factor
+        self.latency = params.latency
+        return True
+
+    def widen(self, factor):
+        self.factor = factor
+        self.threshold = self.baseThreshold*factor
+
+class SwingingDoor:
+    """
+    Error-bounded compression of a scalar series, used instead of the
+    deadband when <key>_compression_error is set. Swinging door trending:
+    a point is only sent when the series can no longer be reconstructed by
+    straight lines between sent points to within the error. A point is also
+    sent if none has been for compression_heartbeat seconds. Samples older
+    than the last one are dropped.
+    """
+    __slots__ = ("id", "dm", "names", "baseError", "factor", "error", "heartbeat", "latency", "archived",
+                 "archivedTime", "last", "lastTime", "upper", "lower")
+
+    def __init__(self, id, spec, params, dm):
         self.id = id
-        self.previous = 0
+        self.dm = dm
+        self.names = spec.names
+        self.archivedTime = None
+        self.factor = 1.0
+        self.configure(params)
+
+    def snapshot(self):
+        return [getattr(self, a, None) for a in ("archived", "archivedTime", "last", "lastTime", "upper", "lower")]
+
+    def restore(self, state):
+        for a, v in zip(("archived", "archivedTime", "last", "lastTime", "upper", "lower"), state):
+            setattr(self, a, v)
+
+    def configure(self, params):
+        self.baseError = params.compressionError
+        self.error = self.baseError*self.factor
+        self.heartbeat = float(config["compression_heartbeat"])
+        self.latency = params.latency
+        return True
+
+    def widen(self, factor):
+        self.factor = factor
+        self.error = self.baseError*factor
 
-    def processBattery(self, resp):
+    def archive(self, timeStamp, v):
+        self.dm.storeValues(self.id, timeStamp, self.names, (v,), self.latency)
+        self.archived = v
+        self.archivedTime = timeStamp
+        self.upper = float("inf")
+        self.lower = float("-inf")
+
+    def archiveOnDoor(self, timeStamp, v):
+        """
+        Ends the line at this point, moved onto the door (by at most the
+        error) so that every point since the last one sent is within the error
+        """
+        dt = timeStamp - self.archivedTime
+        slope = min(max((v - self.archived)/dt, self.lower), self.upper)
+        self.archive(timeStamp, self.archived + slope*dt)
+
+    def process(self, resp):
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["battery_min_change"]:
-            self.dm.storeBattery(self.id, timeStamp, v) 
-            self.previous = v
+        timeStamp = resp["timeStamp"]
+        if self.archivedTime is None:
+            self.archive(timeStamp, v)
+        elif timeStamp < self.lastTime:
+            # Out of order, and the lines already sent can't take it into account
+            return
+        elif timeStamp > self.archivedTime:
+            dt = timeStamp - self.archivedTime
+            upper = min(self.upper, (v + self.error - self.archived)/dt)
+            lower = max(self.lower, (v - self.error - self.archived)/dt)
+            if lower > upper:
+                # The door has closed, so the line ends at the last point
+                if self.lastTime > self.archivedTime:
+                    self.archiveOnDoor(self.lastTime, self.last)
+                if timeStamp == self.archivedTime:
+                    # Same timestamp as the point just sent, so no slope yet
+                    upper = float("inf")
+                    lower = float("-inf")
+                else:
+                    dt = timeStamp - self.archivedTime
+                    upper = (v + self.error - self.archived)/dt
+                    lower = (v - self.error - self.archived)/dt
+            self.upper = upper
+            self.lower = lower
+            if timeStamp - self.archivedTime >= self.heartbeat:
+                self.archiveOnDoor(timeStamp, v)
+        self.last = v
+        self.lastTime = timeStamp
+
+class Rollup:
+    """
+    Time-bucketed aggregation of a scalar series, used when
+    <key>_rollup_interval is set. Each bucket is emitted, timestamped with its
+    start, as <series>_<aggregate> for each of <key>_rollup_aggregates (or
+    rollup_aggregates): mean, min, max, last, count, and twmean, the mean
+    with each value held until the next sample, as for power. A bucket is
+    emitted when the first sample after it arrives. Buckets with no samples
+    still get the held aggregates (last and twmean), up to rollup_max_fill
+    of them. Work per sample is constant.
+    """
+    __slots__ = ("id", "dm", "interval", "maxFill", "aggregates", "latency", "names", "heldAggregates", "heldNames",
+                 "bucketStart", "count", "total", "min", "max", "last", "lastTime", "twTotal", "twStart")
 
-class Connected():
-    def __init__(self, id):
+    def __init__(self, id, spec, params, dm):
         self.id = id
-        self.previous = 0
+        self.dm = dm
+        self.interval = params.rollupInterval
+        self.maxFill = int(config["rollup_max_fill"])
+        self.aggregates = params.rollupAggregates
+        self.latency = params.latency
+        self.names = tuple(spec.names[0] + "_" + a for a in self.aggregates)
+        self.heldAggregates = tuple(a for a in self.aggregates if a in ("last", "twmean"))
+        self.heldNames = tuple(spec.names[0] + "_" + a for a in self.heldAggregates)
+        self.bucketStart = None
+        self.last = None
+        self.lastTime = None
+
+    def open(self, bucketStart):
+        self.bucketStart = bucketStart
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.twTotal = 0.0
+        self.twStart = bucketStart if self.last is not None else None
+
+    def close(self, nextBucket):
+        end = self.bucketStart + self.interval
+        twTotal = self.twTotal + self.last*(end - max(self.lastTime, self.bucketStart))
+        span = end - self.twStart
+        results = {"mean": self.total/self.count,
+                   "min": self.min,
+                   "max": self.max,
+                   "last": self.last,
+                   "count": self.count,
+                   "twmean": twTotal/span if span > 0 else self.last}
+        self.dm.storeValues(self.id, self.bucketStart, self.names, [results[a] for a in self.aggregates], self.latency)
+        if self.heldAggregates:
+            bucketStart = end
+            for b in range(self.maxFill):
+                if bucketStart >= nextBucket:
+                    break
+                self.dm.storeValues(self.id, bucketStart, self.heldNames, (self.last,)*len(self.heldNames), self.latency)
+                bucketStart += self.interval
+
+    def snapshot(self):
+        return [getattr(self, a, None) for a in ("bucketStart", "count", "total", "min", "max", "last", "lastTime",
+                                                  "twTotal", "twStart")]
+
+    def restore(self, state):
+        for a, v in zip(("bucketStart", "count", "total", "min", "max", "last", "lastTime", "twTotal", "twStart"), state):
+            setattr(self, a, v)
+
+    def configure(self, params):
+        self.maxFill = int(config["rollup_max_fill"])
+        self.latency = params.latency
+        return (self.interval, self.aggregates) == (params.rollupInterval, params.rollupAggregates)
 
-    def processConnected(self, resp):
+    def flush(self):
+        """ Emits the bucket in progress, e.g. when the rollup is no longer used """
+        if self.bucketStart is not None and self.count:
+            self.close(self.bucketStart + self.interval)
+        self.bucketStart = None
+
+    def process(self, resp):
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if v:
-            b = 1
+        timeStamp = resp["timeStamp"]
+        if self.lastTime is not None and timeStamp < self.lastTime:
+            return
+        bucketStart = timeStamp - timeStamp % self.interval
+        if bucketStart != self.bucketStart:
+            if self.bucketStart is not None:
+                self.close(bucketStart)
+            self.open(bucketStart)
+        if self.twStart is None:
+            self.twStart = timeStamp
         else:
-            b = 0
-        if b != self.previous:
-            self.dm.storeConnected(self.id, timeStamp-1.0, self.previous)
-            self.dm.storeConnected(self.id, timeStamp, b) 
-            self.previous = b
+            self.twTotal += self.last*(timeStamp - max(self.lastTime, bucketStart))
+        self.count += 1
+        self.total += v
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+        self.last = v
+        self.lastTime = timeStamp
+
+class MotionWindow:
+    """
+    Alternative to deadband detection for 3-axis sensors (motion_mode
+    "window"). Samples are buffered in a NumPy array and each motion_window
+    seconds, aligned to the epoch, the window is summarised as the min, max,
+    mean and RMS of each axis plus the peak magnitude, timestamped with the
+    window start. A window is summarised when the first sample of the next one
+    arrives.
+    """
+    def __init__(self, id, spec, params, dm):
+        self.id = id
+        self.dm = dm
+        self.configure(params)
+        prefix = spec.names[0][:-2]
+        self.names = tuple(n + "_" + a for a in ("min", "max", "mean", "rms") for n in spec.names) + (prefix + "_peak",)
+        self.buf = numpy.empty((64, 3))
+        self.count = 0
+        self.windowStart = None
+
+    def snapshot(self):
+        return [self.windowStart, self.buf[:self.count].tolist()]
+
+    def restore(self, state):
+        self.windowStart = state[0]
+        self.count = len(state[1])
+        if self.count:
+            self.buf = numpy.resize(numpy.array(state[1], dtype=float), (max(64, 2*self.count), 3))
+
+    def configure(self, params):
+        self.window = float(config["motion_window"])
+        self.latency = params.latency
+        return True
+
+    def flush(self):
+        if self.count:
+            self.summarise()
+
+    def process(self, resp):
+        timeStamp = resp["timeStamp"]
+        windowStart = timeStamp - timeStamp % self.window
+        if windowStart != self.windowStart:
+            if self.count:
+                self.summarise()
+            self.windowStart = windowStart
+        if self.count == len(self.buf):
+            self.buf = numpy.resize(self.buf, (2*len(self.buf), 3))
+        data = resp["data"]
+        self.buf[self.count] = (data["x"], data["y"], data["z"])
+        self.count += 1
+
+    def summarise(self):
+        data = self.buf[:self.count]
+        squares = data * data
+        values = numpy.concatenate((data.min(axis=0), data.max(axis=0), data.mean(axis=0),
+                                    numpy.sqrt(squares.mean(axis=0)), [numpy.sqrt(squares.sum(axis=1).max())]))
+        self.dm.storeValues(self.id, self.windowStart, self.names, values.tolist(), self.latency)
+        self.count = 0
+
+class PollingController:
+    """
+    Asks adaptors to poll less often when nearly every sample of a series is
+    being discarded, and more often again when activity rises. Every
+    polling_adapt_interval, each polled series seen at least
+    polling_min_samples times since it was last checked has its pass ratio
+    (samples stored/received) checked: below polling_pass_low its interval is doubled, above
+    polling_pass_high it is halved, within polling_min_factor and
+    polling_max_factor times the configured interval. Only deadband and
+    compressed series are adjusted, as rollups and motion windows need the
+    full sample rate. What is kept is the factor applied to the configured
+    interval, so that it follows changes to the interval and factor limits.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.counts = {}
+        self.factors = {}
+        self.loop = task.LoopingCall(self.check)
+        self.loop.start(float(config["polling_adapt_interval"]), now=False)
+
+    def sample(self, key, passed):
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0, 0]
+        counts[0] += 1
+        if passed:
+            counts[1] += 1
+
+    def factor(self, key):
+        factor = self.factors.get(key, 1.0)
+        return min(max(factor, float(config["polling_min_factor"])), float(config["polling_max_factor"]))
+
+    def interval(self, key, params):
+        return params.pollingInterval*self.factor(key)
+
+    def check(self):
+        changed = set()
+        for key, (received, passed) in list(self.counts.items()):
+            processor = self.app.processors.get(key)
+            base = self.app.params[key[1]].pollingInterval
+            if not processor or not isinstance(processor[2], (Detector, SwingingDoor)) or not base:
+                del self.counts[key]
+                continue
+            if received < int(config["polling_min_samples"]):
+                # Slow series take several checks to build up enough samples
+                continue
+            del self.counts[key]
+            current = self.factor(key)
+            factor = current
+            ratio = float(passed)/received
+            if ratio < float(config["polling_pass_low"]):
+                factor = min(factor*2, float(config["polling_max_factor"]))
+            elif ratio > float(config["polling_pass_high"]):
+                factor = max(factor/2, float(config["polling_min_factor"]))
+            self.factors[key] = factor
+            if factor != current:
+                logging.info("%s %s %s passed %s of %s samples, polling every %ss", ModuleName,
+                             key[0], key[1], passed, received, base*factor)
+                changed.add(key[0])
+        for adtID in changed:
+            self.app.requestServices(adtID)
 
 class App(CbApp):
     def __init__(self, argv):
@@ -369,40 +1956,160 @@ class App(CbApp):
         self.appClass = "monitor"
         self.state = "stopped"
         self.status = "ok"
-        configFile = CB_CONFIG_DIR + "eew_app.config"
-        global config
-        try:
-            with open(configFile, 'r') as configFile:
-                newConfig = json.load(configFile)
-                logging.info('%s Read eew_app.config', ModuleName)
-                config.update(newConfig)
-        except Exception as ex:
-            logging.warning('%s eew_app.config does not exist or file is corrupt', ModuleName)
-            logging.warning("%s Exception: %s %s", ModuleName, type(ex), str(ex.args))
-        for c in config:
-            if c.lower in ("true", "t", "1"):
-                config[c] = True
-            elif c.lower in ("false", "f", "0"):
-                config[c] = False
-        logging.debug('%s Config: %s', ModuleName, config)
-        self.accel = []
-        self.gyro = []
-        self.magnet = []
-        self.temp = []
-        self.irTemp = []
-        self.buttons = []
-        self.humidity = []
-        self.binary = []
-        self.luminance = []
-        self.power = []
-        self.battery = []
-        self.connected = []
+        self.configFile = CB_CONFIG_DIR + "eew_app.config"
+        self.params = loadConfig() or compileSeries(config)
+        self.configTime = self.configMtime()
+        if config["motion_mode"] == "window" and not numpy:
+            logging.warning('%s motion_mode window needs NumPy, using deadband', ModuleName)
+        self.processors = {}
         self.devices = []
         self.devServices = [] 
         self.idToName = {} 
+        self.routes = {}
+        self.services = {}
+        self.dm = None
+        self.metrics = Metrics()
+        self.profiler = None
+        self.profileCount = 0
+        self.history = History(int(config["history_size"])) if int(config["history_size"]) else None
+        self.applySettings()
+        self.recorder = None
+        if config["record_dir"]:
+            self.recorder = Recorder(os.path.join(CB_CONFIG_DIR, config["record_dir"]), self.idToName,
+                                     int(config["record_file_size"]), int(config["record_files"]))
+        self.ingest = collections.deque()
+        self.ingestLimit = int(config["ingest_queue_size"])
+        self.ingestLoop = task.LoopingCall(self.drainIngest)
+        self.startIngest()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.drainIngest)
+        self.snapshotFile = CB_CONFIG_DIR + "eew_app_state.json"
+        self.saved = self.loadSnapshot()
+        self.snapshotState = None
+        reactor.addSystemEventTrigger('before', 'shutdown', self.saveSnapshot)
+        if float(config["snapshot_interval"]) > 0:
+            self.snapshotLoop = task.LoopingCall(self.saveSnapshot)
+            self.snapshotLoop.start(float(config["snapshot_interval"]), now=False)
+        self.polling = None
+        if float(config["polling_adapt_interval"]) > 0:
+            self.polling = PollingController(self)
+            for adtID, characteristic, factor in self.saved.get("polling_factors", []):
+                self.polling.factors[(adtID, characteristic)] = factor
+        if float(config["metrics_interval"]) > 0:
+            self.metricsLoop = task.LoopingCall(self.reportMetrics)
+            self.metricsLoop.start(float(config["metrics_interval"]), now=False)
+        if float(config["config_watch_interval"]) > 0:
+            self.configLoop = task.LoopingCall(self.watchConfig)
+            self.configLoop.start(float(config["config_watch_interval"]), now=False)
         #CbApp.__init__ MUST be called
         CbApp.__init__(self, argv)
 
+    def configMtime(self):
+        try:
+            return os.path.getmtime(self.configFile)
+        except OSError:
+            return None
+
+    def watchConfig(self):
+        mtime = self.configMtime()
+        if mtime != self.configTime:
+            self.configTime = mtime
+            try:
+                self.reloadConfig()
+            except Exception as ex:
+                # Keep watching, so that a corrected file is picked up
+                logging.warning("%s Config reload failed: %s %s", ModuleName, type(ex), str(ex.args))
+
+    def reloadConfig(self):
+        """
+        Re-reads eew_app.config and hands each processor its new parameters
+        without a restart or service discovery. A processor is replaced,
+        route by route, if its type or rollup buckets change. Enabling or
+        disabling a sensor type still needs a restart. If the file is
+        unusable nothing changes.
+        """
+        params = loadConfig()
+        if params is None:
+            return
+        self.params = params
+        self.applySettings()
+        for key, (name, spec, processor) in list(self.processors.items()):
+            params = self.params[spec.characteristic]
+            cls = processorClass(spec, params)
+            if processor.__class__ is cls and processor.configure(params):
+                continue
+            replacement = cls(name, spec, params, self.dm)
+            if hasattr(processor, "flush"):
+                processor.flush()
+            if processor.__class__ is cls:
+                # Same type with new buckets: carry on from what it has seen
+                replacement.restore(processor.snapshot())
+            self.processors[key] = (name, spec, replacement)
+            self.routes[key] = replacement.process
+        if self.dm and self.dm.backpressure.level:
+            self.onBackpressure(self.dm.backpressure.level)
+        logging.info("%s Config reloaded", ModuleName)
+
+    def applySettings(self):
+        """ Settings used for every sample, so that they are not looked up in config each time """
+        self.historyRaw = self.history is not None and config["history_raw"] is True
+        self.profileEvery = int(config["profile_every"])
+        if not self.profileEvery:
+            self.profiler = None
+        elif not self.profiler:
+            self.profiler = cProfile.Profile()
+
+    def loadSnapshot(self):
+        try:
+            with open(self.snapshotFile, 'r') as f:
+                saved = json.load(f)
+            logging.info("%s Restoring state of %s series from %s", ModuleName, len(saved["processors"]),
+                         time.ctime(saved["time"]))
+            return saved
+        except IOError:
+            pass
+        except Exception as ex:
+            logging.warning("%s Could not read %s: %s %s", ModuleName, self.snapshotFile, type(ex), str(ex.args))
+        return {"processors": {}, "buffers": {}}
+
+    def saveSnapshot(self):
+        """
+        Detector state and samples not yet sent, so that a restart neither
+        loses them nor reports a change for every sensor. Series whose adaptors
+        have not been seen since startup keep their saved state. The time each
+        series has been flushed up to is saved too, and saved again when a
+        device with samples in the snapshot is flushed, so that samples sent
+        since the snapshot are not sent again after a crash.
+        """
+        processors = dict(self.saved["processors"])
+        for (adtID, characteristic), (name, spec, processor) in self.processors.items():
+            processors[adtID + "|" + characteristic] = [processor.__class__.__name__, processor.snapshot()]
+        state = {"time": time.time(),
+                 "processors": processors,
+                 "buffers": self.dm.snapshot() if self.dm else self.saved["buffers"],
+                 "flushed": self.dm.flushed if self.dm else self.saved.get("flushed", {})}
+        if self.polling:
+            state["polling_factors"] = [[adtID, characteristic, factor]
+                                        for (adtID, characteristic), factor in self.polling.factors.items()]
+        self.snapshotState = state
+        self.writeSnapshot(state)
+
+    def onFlushed(self, pending):
+        """ Saves the new flushed times if any of the samples flushed were in the snapshot """
+        buffers = self.snapshotState["buffers"] if self.snapshotState else {}
+        flushed = [deviceID for deviceID in pending if deviceID in buffers]
+        if flushed:
+            self.snapshotState["buffers"] = dict((deviceID, series) for deviceID, series in buffers.items()
+                                                 if deviceID not in flushed)
+            self.writeSnapshot(self.snapshotState)
+
+    def writeSnapshot(self, state):
+        try:
+            with open(self.snapshotFile + ".tmp", 'w') as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.rename(self.snapshotFile + ".tmp", self.snapshotFile)
+        except Exception as ex:
+            logging.warning("%s Could not write %s: %s %s", ModuleName, self.snapshotFile, type(ex), str(ex.args))
+
     def setState(self, action):
         if action == "clear_error":
             self.state = "running"
@@ -429,162 +2136,209 @@ class App(CbApp):
                        }
                   }
             self.sendMessage(msg, "conc")
+        elif resp["resp"] == "query":
+            self.onQuery(resp)
         else:
             msg = {"appID": self.id,
                    "msg": "error",
                    "message": "unrecognised response from concentrator"}
             self.sendMessage(msg, "conc")
 
+    def onQuery(self, resp):
+        """
+        Answers a local query for recent values from History. resp has
+        "query": "series", "latest", "range" or "downsample", and for the last
+        three "device" and "series", with optional "kind" ("raw" or
+        "uploaded", default uploaded), "start", "end" and "points" (at most
+        history_size). "ref" is returned unchanged so that replies can be
+        matched to requests.
+        """
+        query = resp.get("query")
+        try:
+            start = None if resp.get("start") is None else float(resp["start"])
+            end = None if resp.get("end") is None else float(resp["end"])
+            points = min(max(int(resp.get("points", 60)), 1), int(config["history_size"]) or 1)
+        except (TypeError, ValueError):
+            self.queryError(resp, "bad query parameters")
+            return
+        result = None
+        if self.history and query == "series":
+            result = self.history.series()
+        elif self.history and query in ("latest", "range", "downsample"):
+            buf = self.history.get(resp.get("kind", "uploaded"), resp.get("device"), resp.get("series"))
+            if buf is not None:
+                if query == "latest":
+                    result = buf.latest()
+                elif start is not None and end is not None and start > end:
+                    result = []
+                elif query == "range":
+                    result = buf.samples(start, end)
+                else:
+                    result = buf.downsample(start, end, points)
+        if result is None:
+            self.queryError(resp, "no history for query")
+            return
+        msg = {
+           "msg": "req",
+           "verb": "post",
+           "channel": int(self.id[3:]),
+           "body": {
+                    "msg": "query",
+                    "appID": self.id,
+                    "ref": resp.get("ref"),
+                    "query": query,
+                    "result": result
+                   }
+              }
+        self.sendMessage(msg, "conc")
+
+    def queryError(self, resp, message):
+        msg = {"appID": self.id,
+               "msg": "error",
+               "message": message,
+               "ref": resp.get("ref")}
+        self.sendMessage(msg, "conc")
+
     def onAdaptorData(self, message):
         """
-        This method is called in a thread by cbcommslib so it will not cause
-        problems if it takes some time to complete (other than to itself).
+        This method is called in a thread by cbcommslib. Samples are only
+        queued here (deque appends need no lock) and processed in batches by
+        drainIngest on the reactor thread, so buffers, timers and uploads are
+        only ever touched from that one thread.
         """
         #logging.debug("%s onadaptorData, message: %s", ModuleName, message)
-        if message["characteristic"] == "acceleration":
-            for a in self.accel:
-                if a.id == self.idToName[message["id"]]: 
-                    a.processAccel(message)
-                    break
-        elif message["characteristic"] == "temperature":
-            for t in self.temp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processTemp(message)
-                    break
-        elif message["characteristic"] == "ir_temperature":
-            for t in self.irTemp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processIrTemp(message)
-                    break
-        elif message["characteristic"] == "gyro":
-            for g in self.gyro:
-                if g.id == self.idToName[message["id"]]:
-                    g.processGyro(message)
-                    break
-        elif message["characteristic"] == "magnetometer":
-            for g in self.magnet:
-                if g.id == self.idToName[message["id"]]:
-                    g.processMagnet(message)
-                    break
-        elif message["characteristic"] == "buttons":
-            for b in self.buttons:
-                if b.id == self.idToName[message["id"]]:
-                    b.processButtons(message)
-                    break
-        elif message["characteristic"] == "humidity":
-            for b in self.humidity:
-                if b.id == self.idToName[message["id"]]:
-                    b.processHumidity(message)
-                    break
-        elif message["characteristic"] == "binary_sensor":
-            for b in self.binary:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBinary(message)
-                    break
-        elif message["characteristic"] == "power":
-            for b in self.power:
-                if b.id == self.idToName[message["id"]]:
-                    b.processPower(message)
-                    break
-        elif message["characteristic"] == "battery":
-            for b in self.battery:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBattery(message)
-                    break
-        elif message["characteristic"] == "connected":
-            for b in self.connected:
-                if b.id == self.idToName[message["id"]]:
-                    b.processConnected(message)
-                    break
-        elif message["characteristic"] == "luminance":
-            for b in self.luminance:
-                if b.id == self.idToName[message["id"]]:
-                    b.processLuminance(message)
-                    break
+        if len(self.ingest) < self.ingestLimit:
+            self.ingest.append(message)
+        else:
+            self.metrics.overflowed += 1
+
+    def startIngest(self):
+        d = self.ingestLoop.start(float(config["ingest_interval"]), now=False)
+        d.addErrback(self.onIngestError)
+
+    def onIngestError(self, failure):
+        # Backstop: the loop stops if drainIngest ever raises, so start it again
+        logging.error("%s Ingest loop stopped: %s, restarting", ModuleName, failure.getErrorMessage())
+        self.startIngest()
+
+    def drainIngest(self):
+        """
+        Processes what was queued before this tick, in arrival order. A bad
+        message is logged and skipped, as it only affects itself.
+        """
+        popleft = self.ingest.popleft
+        for i in range(len(self.ingest)):
+            message = popleft()
+            try:
+                self.processSample(message)
+            except Exception as ex:
+                logging.warning("%s Could not process %s: %s %s", ModuleName, message, type(ex), str(ex.args))
+
+    def processSample(self, message):
+        # Routes are built in onAdaptorService, so unknown adaptors and
+        # characteristics that were not requested are simply dropped
+        characteristic = message.get("characteristic")
+        handler = self.routes.get((message.get("id"), characteristic))
+        if not handler:
+            self.metrics.unrouted += 1
+            return
+        if self.recorder:
+            self.recorder.record(message)
+        if self.historyRaw:
+            name, spec, processor = self.processors[(message["id"], characteristic)]
+            self.history.store("raw", name, message["timeStamp"], spec.names, spec.decode(message["data"]))
+        ingested = self.metrics.ingested
+        ingested[characteristic] = ingested.get(characteristic, 0) + 1
+        stored = self.dm.stored
+        if self.profiler:
+            self.profileCount += 1
+            if self.profileCount % self.profileEvery == 0:
+                self.profiler.runcall(handler, message)
+            else:
+                handler(message)
+        else:
+            handler(message)
+        if self.dm.stored != stored:
+            passed = self.metrics.passed
+            passed[characteristic] = passed.get(characteristic, 0) + 1
+            if self.polling:
+                self.polling.sample((message["id"], characteristic), True)
+        elif self.polling:
+            self.polling.sample((message["id"], characteristic), False)
+
+    def reportMetrics(self):
+        stats = self.metrics.report(self.dm)
+        stats["ingest_queue"] = len(self.ingest)
+        if config["metrics_file"]:
+            try:
+                with open(CB_CONFIG_DIR + config["metrics_file"], 'a') as f:
+                    f.write(json.dumps(stats) + "\n")
+            except Exception as ex:
+                logging.warning("%s Could not write stats: %s %s", ModuleName, type(ex), str(ex.args))
+        else:
+            self.sendManagerMessage({"id": self.id,
+                                     "status": "stats",
+                                     "stats": stats})
+        if self.profiler:
+            self.profiler.dump_stats(CB_CONFIG_DIR + "eew_app.prof")
 
     def onAdaptorService(self, message):
         #logging.debug("%s onAdaptorService, message: %s", ModuleName, message)
         self.devServices.append(message)
-        serviceReq = []
+        characteristics = []
+        name = self.idToName[message["id"]]
         for p in message["service"]:
             # Based on services offered & whether we want to enable them
-            if p["characteristic"] == "temperature":
-                if config["temperature"] == 'True':
-                    self.temp.append(TemperatureMeasure((self.idToName[message["id"]])))
-                    self.temp[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "temperature",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "ir_temperature":
-                if config["irtemperature"] == 'True':
-                    self.irTemp.append(IrTemperatureMeasure(self.idToName[message["id"]]))
-                    self.irTemp[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "ir_temperature",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "acceleration":
-                if config["accel"] == 'True':
-                    self.accel.append(Accelerometer((self.idToName[message["id"]])))
-                    serviceReq.append({"characteristic": "acceleration",
-                                       "interval": config["accel_polling_interval"]})
-                    self.accel[-1].dm = self.dm
-            elif p["characteristic"] == "gyro":
-                if config["gyro"] == 'True':
-                    self.gyro.append(Gyro(self.idToName[message["id"]]))
-                    self.gyro[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "gyro",
-                                       "interval": config["gyro_polling_interval"]})
-            elif p["characteristic"] == "magnetometer":
-                if config["magnet"] == 'True': 
-                    self.magnet.append(Magnet(self.idToName[message["id"]]))
-                    self.magnet[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "magnetometer",
-                                       "interval": config["magnet_polling_interval"]})
-            elif p["characteristic"] == "buttons":
-                if config["buttons"] == 'True':
-                    self.buttons.append(Buttons(self.idToName[message["id"]]))
-                    self.buttons[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "buttons",
-                                       "interval": 0})
-            elif p["characteristic"] == "humidity":
-                if config["humidity"] == 'True':
-                    self.humidity.append(Humid(self.idToName[message["id"]]))
-                    self.humidity[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "humidity",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "binary_sensor":
-                if config["binary"] == 'True':
-                    self.binary.append(Binary(self.idToName[message["id"]]))
-                    self.binary[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "binary_sensor",
-                                       "interval": 0})
-            elif p["characteristic"] == "power":
-                if config["power"] == 'True':
-                    self.power.append(Power(self.idToName[message["id"]]))
-                    self.power[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "power",
-                                       "interval": 0})
-            elif p["characteristic"] == "battery":
-                if config["battery"] == 'True':
-                    self.battery.append(Battery(self.idToName[message["id"]]))
-                    self.battery[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "battery",
-                                       "interval": 0})
-            elif p["characteristic"] == "connected":
-                if config["connected"] == 'True':
-                    self.connected.append(Connected(self.idToName[message["id"]]))
-                    self.connected[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "connected",
-                                       "interval": 0})
-            elif p["characteristic"] == "luminance":
-                if config["luminance"] == 'True':
-                    self.luminance.append(Luminance(self.idToName[message["id"]]))
-                    self.luminance[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "luminance",
-                                       "interval": 0})
+            spec = SERIES.get(p["characteristic"])
+            if spec and self.params[spec.characteristic].enabled:
+                params = self.params[spec.characteristic]
+                cls = processorClass(spec, params)
+                key = (message["id"], spec.characteristic)
+                if key in self.processors and self.processors[key][2].__class__ is cls:
+                    # The adaptor has offered its services again, so carry on as we were
+                    detector = self.processors[key][2]
+                else:
+                    detector = cls(name, spec, params, self.dm)
+                    saved = self.saved["processors"].pop(message["id"] + "|" + spec.characteristic, None)
+                    if saved and saved[0] == cls.__name__:
+                        try:
+                            detector.restore(saved[1])
+                        except Exception as ex:
+                            logging.warning("%s Could not restore %s: %s %s", ModuleName, key, type(ex), str(ex.args))
+                self.processors[key] = (name, spec, detector)
+                self.routes[key] = detector.process
+                characteristics.append(spec.characteristic)
+        self.services[message["id"]] = characteristics
+        self.requestServices(message["id"])
+        self.setState("running")
+        if self.dm.backpressure.level:
+            self.onBackpressure(self.dm.backpressure.level)
+
+    def requestServices(self, adtID):
+        """ Asks an adaptor for the characteristics we use, at the current polling intervals """
+        serviceReq = []
+        for characteristic in self.services[adtID]:
+            params = self.params[characteristic]
+            interval = self.polling.interval((adtID, characteristic), params) if self.polling else params.pollingInterval
+            serviceReq.append({"characteristic": characteristic,
+                               "interval": interval})
         msg = {"id": self.id,
                "request": "service",
                "service": serviceReq}
-        self.sendMessage(msg, message["id"])
-        self.setState("running")
+        self.sendMessage(msg, adtID)
+
+    def onBackpressure(self, level):
+        """
+        Sheds load in priority order as the upload backlog grows, see
+        Backpressure. Series keep their names and processors, so nothing
+        changes for consumers except how much is sent.
+        """
+        factor = float(config["backpressure_deadband_factor"])
+        for key, (name, spec, processor) in self.processors.items():
+            if spec.detection == "change_any" and isinstance(processor, Detector):
+                processor.widen(factor if level >= 1 else 1.0)
+            elif spec.detection in ("change", "step") and isinstance(processor, (Detector, SwingingDoor)):
+                processor.widen(factor if level >= 2 else 1.0)
 
     def onConfigureMessage(self, config):
         """ Config is based on what sensors are available """
@@ -597,8 +2351,19 @@ class App(CbApp):
                 logging.debug("%s Configure app. Adaptor name: %s", ModuleName, name)
                 self.idToName[adtID] = friendly_name.replace(" ", "_")
                 self.devices.append(adtID)
-        self.dm = DataManager(self.bridge_id)
-        self.setState("starting")
+        if self.dm is None:
+            # Configure is re-called when devices are added, and the buffers,
+            # spools and connections carry on across that
+            self.dm = DataManager(self.bridge_id, self.metrics, self.history)
+            self.dm.backpressure.listeners.append(self.onBackpressure)
+            self.dm.flushListeners.append(self.onFlushed)
+            self.dm.restore(self.saved["buffers"], self.saved.get("flushed", {}))
+            self.saved["buffers"] = {}
+            self.setState("starting")
+        # State saved for adaptors that are no longer configured would be carried forever
+        for saved in list(self.saved["processors"]):
+            if saved.split("|")[0] not in self.devices:
+                del self.saved["processors"][saved]
 
 if __name__ == '__main__':
     App(sys.argv)
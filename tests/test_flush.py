@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# test_flush.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" DataManager's flush policy against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+IMMEDIATE = (0.0, 0.0)
+BULK = (30.0, 300.0)
+
+class Clock:
+    """ Stands in for the time module, so that the test decides what time it is """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class FlushTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(1000.0)
+        self.time = eew_app_a.time
+        eew_app_a.time = self.clock
+        self.dm = eew_app_a.DataManager("BID", eew_app_a.Metrics(), None)
+        self.posted = []
+        self.dm.post = self.posted.append
+        self.armed = 0
+        onDeadline = self.dm.onDeadline
+        def countDeadline(key):
+            self.armed += 1
+            onDeadline(key)
+        self.dm.onDeadline = countDeadline
+
+    def tearDown(self):
+        for unit in self.dm.units.values():
+            if unit.timer and unit.timer.active():
+                unit.timer.cancel()
+        self.dm.backpressure.loop.stop()
+        for sink in self.dm.sinks:
+            sink.spool.close()
+        eew_app_a.time = self.time
+
+    def expire(self, key="dev"):
+        """ Runs the unit's deadline timer now, as the reactor would """
+        unit = self.dm.units[key]
+        self.clock.now = unit.deadline
+        unit.timer.cancel()
+        self.dm.onDeadline(key)
+
+    def test_max_samples(self):
+        for i in range(self.dm.maxSamples):
+            self.dm.storeValues("dev", 1000.0 + i, ("temperature",), (20.0,), BULK)
+        self.assertEqual(self.dm.units["dev"].deadline, self.clock.now)
+
+    def test_edge_does_not_inflate_rate(self):
+        # An immediate flush of a binary edge, then a lone bulk sample
+        self.dm.storeValues("dev", 999.0, ("binary",), (0,), IMMEDIATE)
+        self.dm.storeValues("dev", 1000.0, ("binary",), (1,), IMMEDIATE)
+        self.expire()
+        self.assertEqual(len(self.posted), 1)
+        self.clock.now += 1.0
+        self.dm.storeValues("dev", 1001.0, ("temperature",), (20.0,), BULK)
+        self.expire()
+        self.assertEqual(len(self.posted), 1)
+        unit = self.dm.units["dev"]
+        self.assertGreater(unit.deadline - self.clock.now, 100.0)
+        self.expire()
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(unit.deadline, unit.latest)
+        self.expire()
+        self.assertEqual(len(self.posted), 2)
+        self.assertEqual(self.clock.now, 1001.0 + BULK[1])
+
+    def test_rate_window(self):
+        # A busy minute, then a lone sample long after it
+        for i in range(600):
+            self.clock.now = 1000.0 + i*0.1
+            self.dm.storeValues("dev", self.clock.now, ("power",), (float(i),), BULK)
+        self.dm.flush("dev")
+        rate = self.dm.rates["dev"][BULK]
+        self.assertAlmostEqual(rate.rate(self.clock.now), 10.0, delta=1.0)
+        self.clock.now += 600.0
+        self.assertEqual(rate.rate(self.clock.now), 0.0)
+
+    def test_high_rate_does_not_spin(self):
+        # A high rate leaves one sample pending: it must not be re-armed over and over
+        for i in range(1000):
+            self.dm.storeValues("dev", 1000.0, ("power",), (float(i),), BULK)
+        self.dm.flush("dev")
+        self.armed = 0
+        self.dm.storeValues("dev", 1000.0, ("power",), (1.0,), BULK)
+        unit = self.dm.units["dev"]
+        while "dev" in self.dm.units:
+            self.expire()
+        self.assertLessEqual(self.armed, 3)
+        self.assertEqual(self.clock.now, unit.latest)
+
+    def test_min_samples_arrive(self):
+        # Ten samples in the first 10s, so the other ten should take about 30s more
+        for i in range(10):
+            self.clock.now = 1000.0 + i
+            self.dm.storeValues("dev", self.clock.now, ("power",), (float(i),), BULK)
+        self.expire()
+        self.assertFalse(self.posted)
+        self.assertAlmostEqual(self.dm.units["dev"].deadline, 1060.0, delta=1.0)
+        for i in range(10):
+            self.clock.now += 1.0
+            self.dm.storeValues("dev", self.clock.now, ("power",), (1.0,), BULK)
+        self.expire()
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(len(self.posted[0]["dev"]), 20)
+
+    def test_values(self):
+        # Integer series go out as ints, and a sample with a bad value is dropped whole
+        self.dm.storeValues("dev", 1000.0, ("binary",), (1,), BULK)
+        self.dm.storeValues("dev", 1000.0, ("power",), (0,), BULK)
+        self.dm.storeValues("dev", 1001.0, ("accel_x", "accel_y", "accel_z"), (0.1, 0.2, 0.3), BULK)
+        self.dm.storeValues("dev", 1002.0, ("accel_x", "accel_y", "accel_z"), (0.1, 0.2, None), BULK)
+        self.dm.storeValues("dev", 1003.0, ("power",), ("on",), BULK)
+        self.assertEqual(self.dm.stored, 3)
+        self.dm.flush("dev")
+        posted = dict((v["n"], []) for v in self.posted[0]["dev"])
+        for v in self.posted[0]["dev"]:
+            posted[v["n"]].append(v["v"])
+        self.assertEqual(posted, {"binary": [1], "power": [0.0], "accel_x": [0.1], "accel_y": [0.2], "accel_z": [0.3]})
+        self.assertTrue(isinstance(posted["binary"][0], int))
+
+if __name__ == '__main__':
+    unittest.main()
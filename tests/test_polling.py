@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# test_polling.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" Adaptive polling against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import json
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+CONFIG_FILE = eew_app_a.CB_CONFIG_DIR + "eew_app.config"
+STATE_FILE = eew_app_a.CB_CONFIG_DIR + "eew_app_state.json"
+KEY = ("ADT1", "temperature")
+
+class PollingTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(eew_app_a.config)
+        self.writeConfig({})
+        self.app = eew_app_a.App([])
+        self.requests = []
+        self.app.sendMessage = lambda msg, to: self.requests.append(msg["service"]) if to == "ADT1" else None
+        self.app.onConfigureMessage({"adaptors": [{"id": "ADT1", "name": "n", "friendly_name": "S"}]})
+        self.app.dm.post = lambda batch: None
+        self.app.onAdaptorService({"id": "ADT1", "service": [{"characteristic": "temperature"}]})
+        self.t = 1000.0
+        # The first sample is always sent, so it is not counted
+        self.check(True, 1)
+        self.app.polling.counts.clear()
+
+    def tearDown(self):
+        app = self.app
+        for loop in (app.ingestLoop, app.snapshotLoop, app.polling.loop, app.configLoop, app.dm.backpressure.loop):
+            if loop.running:
+                loop.stop()
+        for unit in app.dm.units.values():
+            if unit.timer and unit.timer.active():
+                unit.timer.cancel()
+        for sink in app.dm.sinks:
+            sink.spool.close()
+        for path in (CONFIG_FILE, STATE_FILE, eew_app_a.CB_CONFIG_DIR + "eew_app_spool.db"):
+            if os.path.exists(path):
+                os.remove(path)
+        eew_app_a.config.clear()
+        eew_app_a.config.update(self.config)
+
+    def writeConfig(self, settings):
+        settings = dict(settings, upload_workers=0)
+        with open(CONFIG_FILE, "w") as f:
+            json.dump(settings, f)
+
+    def interval(self):
+        return self.requests[-1][0]["interval"]
+
+    def check(self, steady, samples=10):
+        """ One adapt interval of temperature samples, steady or changing each time """
+        for i in range(samples):
+            self.t += 1.0
+            v = 20.0 if steady else 20.0 + (i % 2)*5.0
+            self.app.onAdaptorData({"id": "ADT1", "characteristic": "temperature", "timeStamp": self.t, "data": v})
+        self.app.drainIngest()
+        self.app.polling.check()
+
+    def test_adapts_within_limits(self):
+        self.assertEqual(self.interval(), 600.0)
+        for i in range(5):
+            self.check(True)
+        self.assertEqual(self.interval(), 4800.0)
+        self.check(False)
+        self.assertEqual(self.interval(), 2400.0)
+        for i in range(5):
+            self.check(False)
+        self.assertEqual(self.interval(), 600.0)
+
+    def test_too_few_samples(self):
+        # Samples build up across checks until there are polling_min_samples
+        self.check(True, 5)
+        self.assertEqual(self.interval(), 600.0)
+        self.check(True, 5)
+        self.assertEqual(self.interval(), 1200.0)
+
+    def test_limits_changed(self):
+        for i in range(3):
+            self.check(True)
+        self.assertEqual(self.interval(), 4800.0)
+        self.writeConfig({"polling_max_factor": 2.0, "slow_polling_interval": 300.0})
+        self.app.reloadConfig()
+        self.app.requestServices("ADT1")
+        self.assertEqual(self.interval(), 600.0)
+
+    def test_saved_as_factor(self):
+        for i in range(2):
+            self.check(True)
+        self.app.saveSnapshot()
+        with open(STATE_FILE) as f:
+            self.assertEqual(json.load(f)["polling_factors"], [["ADT1", "temperature", 4.0]])
+
+if __name__ == '__main__':
+    unittest.main()
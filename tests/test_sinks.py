@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# test_sinks.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" Upload sinks and their queues against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+def values(*vs):
+    return [{"n": "power", "v": v, "t": 1000.0 + v} for v in vs]
+
+class HealthTest(unittest.TestCase):
+    def test_backoff(self):
+        health = eew_app_a.EndpointHealth(3, 2.0, 60.0)
+        for failures, backoff in ((1, 2.0), (2, 4.0), (3, 8.0), (10, 60.0)):
+            while health.failures < failures:
+                health.failure()
+            for i in range(20):
+                self.assertTrue(backoff/2 <= health.delay() <= backoff)
+
+    def test_states(self):
+        health = eew_app_a.EndpointHealth(3, 2.0, 60.0)
+        health.failure()
+        health.failure()
+        health.success()
+        health.failure()
+        health.failure()
+        self.assertEqual(health.state, "closed")
+        health.failure()
+        self.assertEqual(health.state, "open")
+        health.probe()
+        self.assertEqual(health.state, "half_open")
+        health.failure()
+        self.assertEqual(health.state, "open")
+        health.probe()
+        health.success()
+        self.assertEqual((health.state, health.failures), ("closed", 0))
+
+class SinkTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(eew_app_a.config)
+        # No upload threads, so jobs stay in the queues to be looked at
+        eew_app_a.config.update({"sinks": [{"name": "a", "type": "http"}, {"name": "b", "type": "http"}],
+                                 "upload_workers": 0,
+                                 "upload_queue_size": 1,
+                                 "upload_queue_policy": "coalesce"})
+        self.dm = eew_app_a.DataManager("BID", eew_app_a.Metrics(), None)
+
+    def tearDown(self):
+        self.dm.backpressure.loop.stop()
+        for sink in self.dm.sinks:
+            if sink.replayTimer and sink.replayTimer.active():
+                sink.replayTimer.cancel()
+            sink.spool.close()
+            os.remove(eew_app_a.CB_CONFIG_DIR + "eew_app_spool_" + sink.name + ".db")
+        eew_app_a.config.clear()
+        eew_app_a.config.update(self.config)
+
+    def test_coalesce_shared_batch(self):
+        self.dm.post({"dev": values(1)})
+        self.dm.post({"dev": values(2)})
+        for sink in self.dm.sinks:
+            self.assertEqual(len(sink.uploader.jobs), 1)
+            job = sink.uploader.jobs[0]
+            self.assertEqual([v["v"] for v in job.values], [1, 2])
+            self.assertEqual(job.batch, {"dev": values(1, 2)})
+
+    def test_failed_coalesced_job_spools_once(self):
+        self.dm.post({"dev": values(1)})
+        self.dm.post({"dev": values(2)})
+        a, b = self.dm.sinks
+        job = b.uploader.jobs.popleft()
+        b.uploader.sending.add(job)
+        b.onResult(job, False)
+        self.assertEqual(b.spool.peek()[1:], ("dev", values(1, 2)))
+        self.assertEqual(len(b.spool), 2)
+        self.assertEqual(len(a.spool), 0)
+
+    def test_drop_oldest_replays(self):
+        # Only a replay is queued, so the new job is spooled rather than going over the bound
+        a, b = self.dm.sinks
+        a.uploader.policy = "drop_oldest"
+        a.uploader.submit(eew_app_a.UploadJob("url", {"dev": values(1)}, values(1), seq=1))
+        a.uploader.submit(eew_app_a.UploadJob("url", {"dev": values(2)}, values(2)))
+        self.assertEqual(len(a.uploader.jobs), 1)
+        self.assertEqual(a.uploader.jobs[0].seq, 1)
+        self.assertEqual(a.spool.peek()[1:], ("dev", values(2)))
+
+    def test_close_waits_for_upload(self):
+        a, b = self.dm.sinks
+        self.dm.post({"dev": values(1)})
+        job = a.uploader.jobs.popleft()
+        a.uploader.sending.add(job)
+        self.assertEqual(b.close(), None)
+        closed = []
+        a.close().addCallback(closed.append)
+        self.assertFalse(closed)
+        a.onResult(job, True)
+        self.assertEqual(closed, [None])
+        self.assertEqual(len(a.spool), 0)
+
+    def test_close_spools_unfinished_upload(self):
+        a, b = self.dm.sinks
+        self.dm.post({"dev": values(1)})
+        job = a.uploader.jobs.popleft()
+        a.uploader.sending.add(job)
+        closed = []
+        a.close().addCallback(closed.append)
+        # As when shutdown_upload_timeout runs out
+        a.closed()
+        self.assertEqual(closed, [None])
+        # A late result is ignored, as the values are already spooled
+        a.onResult(job, True)
+        spool = eew_app_a.Spool(eew_app_a.CB_CONFIG_DIR + "eew_app_spool_a.db", 100)
+        self.assertEqual(spool.peek()[1:], ("dev", values(1)))
+        self.assertEqual(len(spool), 1)
+        spool.close()
+
+    def send(self, sink, ok):
+        """ The sink's next queued job, as an upload thread would send it """
+        job = sink.uploader.jobs.popleft()
+        sink.uploader.sending.add(job)
+        sink.onResult(job, ok)
+        return job
+
+    def test_breaker(self):
+        a, b = self.dm.sinks
+        threshold = a.health.threshold
+        for i in range(threshold):
+            self.dm.post({"dev": values(i)})
+            self.assertEqual(a.health.state, "closed")
+            self.send(a, False)
+        self.assertEqual(a.health.state, "open")
+        self.assertTrue(a.replayTimer.active())
+        # While open, nothing new is sent
+        self.dm.post({"dev": values(threshold)})
+        self.assertEqual(len(a.uploader.jobs), 0)
+        self.assertEqual(len(a.spool), threshold + 1)
+        # Half open: one probe, the oldest spooled entry, which fails
+        a.replayTimer.cancel()
+        a.retry()
+        self.assertEqual(a.health.state, "half_open")
+        self.assertEqual(len(a.uploader.jobs), 1)
+        self.assertEqual(self.send(a, False).values, values(0))
+        self.assertEqual(a.health.state, "open")
+        self.assertEqual(len(a.spool), threshold + 1)
+        # The next probe gets through, and the rest are replayed in order
+        a.replayTimer.cancel()
+        a.retry()
+        replayed = []
+        while a.uploader.jobs:
+            replayed.extend(v["v"] for v in self.send(a, True).values)
+        self.assertEqual(a.health.state, "closed")
+        self.assertEqual(replayed, list(range(threshold + 1)))
+        self.assertEqual(len(a.spool), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# test_snapshot.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" Warm restart state against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import json
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+CONFIG_FILE = eew_app_a.CB_CONFIG_DIR + "eew_app.config"
+STATE_FILE = eew_app_a.CB_CONFIG_DIR + "eew_app_state.json"
+ADAPTORS = {"adaptors": [{"id": "ADT1", "name": "n", "friendly_name": "S"}]}
+SERVICES = {"id": "ADT1", "service": [{"characteristic": "temperature"}, {"characteristic": "power"}]}
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(eew_app_a.config)
+        with open(CONFIG_FILE, "w") as f:
+            json.dump({"upload_workers": 0, "temp_compression_error": 0.5}, f)
+        self.apps = []
+
+    def tearDown(self):
+        for app in self.apps:
+            for loop in (app.ingestLoop, app.snapshotLoop, app.polling.loop, app.configLoop, app.dm.backpressure.loop):
+                if loop.running:
+                    loop.stop()
+            for unit in app.dm.units.values():
+                if unit.timer and unit.timer.active():
+                    unit.timer.cancel()
+            for sink in app.dm.sinks:
+                sink.spool.close()
+        for path in (CONFIG_FILE, STATE_FILE, eew_app_a.CB_CONFIG_DIR + "eew_app_spool.db"):
+            if os.path.exists(path):
+                os.remove(path)
+        eew_app_a.config.clear()
+        eew_app_a.config.update(self.config)
+
+    def start(self, adaptors=ADAPTORS, services=SERVICES):
+        app = eew_app_a.App([])
+        self.apps.append(app)
+        app.sendMessage = lambda msg, to: None
+        app.onConfigureMessage(adaptors)
+        self.posted = []
+        app.dm.post = self.posted.append
+        if services:
+            app.onAdaptorService(services)
+        return app
+
+    def feed(self, app, timeStamp, temperature, power):
+        app.onAdaptorData({"id": "ADT1", "characteristic": "temperature", "timeStamp": timeStamp, "data": temperature})
+        app.onAdaptorData({"id": "ADT1", "characteristic": "power", "timeStamp": timeStamp, "data": power})
+        app.drainIngest()
+
+    def pending(self, app):
+        return dict((name, list(zip(buf.t, buf.v))) for name, buf in app.dm.s.get("S", {}).items())
+
+    def test_round_trip(self):
+        app = self.start()
+        self.feed(app, 1000.0, 20.0, 100.0)
+        self.feed(app, 1010.0, 25.0, 200.0)
+        processors = dict((key, p.snapshot()) for key, (name, spec, p) in app.processors.items())
+        pending = self.pending(app)
+        app.saveSnapshot()
+        restarted = self.start()
+        self.assertEqual(self.pending(restarted), pending)
+        self.assertEqual(dict((key, p.snapshot()) for key, (name, spec, p) in restarted.processors.items()),
+                         processors)
+        self.assertEqual(restarted.dm.units["S"].count, sum(len(s) for s in pending.values()))
+
+    def test_flushed_not_sent_again(self):
+        app = self.start()
+        self.feed(app, 1000.0, 20.0, 100.0)
+        app.saveSnapshot()
+        app.dm.flush("S")
+        self.feed(app, 1010.0, 25.0, 200.0)
+        # A crash now: the periodic snapshot has samples that have been sent since
+        restarted = self.start()
+        self.assertEqual(self.pending(restarted), {})
+        restarted.dm.restore({"S": {"power": [[1000.0, 1010.0], [100.0, 200.0]]}}, {})
+        self.assertEqual(self.pending(restarted), {"power": [(1010.0, 200.0)]})
+
+    def test_unknown_adaptors_pruned(self):
+        app = self.start()
+        self.feed(app, 1000.0, 20.0, 100.0)
+        app.saveSnapshot()
+        # ADT1 is no longer configured, so its saved state is not kept
+        restarted = self.start({"adaptors": [{"id": "ADT2", "name": "n", "friendly_name": "T"}]}, None)
+        restarted.saveSnapshot()
+        with open(STATE_FILE) as f:
+            self.assertEqual(json.load(f)["processors"], {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# test_spool.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" Spool against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+def values(*vs):
+    return [{"n": "power", "v": v, "t": 1000.0 + v} for v in vs]
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spool.db")
+        self.spool = eew_app_a.Spool(self.path, 3)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def drain(self, spool):
+        """ Everything spooled, oldest first, acking as a replay does """
+        entries = []
+        entry = spool.peek()
+        while entry is not None:
+            entries.append(entry[1:])
+            spool.ack(entry[0])
+            entry = spool.peek()
+        return entries
+
+    def test_memory(self):
+        self.spool.push("a", values(1))
+        self.spool.push("b", values(2, 3))
+        self.assertEqual(len(self.spool), 3)
+        self.assertEqual(self.spool.diskRows, 0)
+        self.assertEqual(self.drain(self.spool), [("a", values(1)), ("b", values(2, 3))])
+        self.assertEqual(len(self.spool), 0)
+
+    def test_order_across_disk(self):
+        # Over the memory limit, and everything after it, goes to disk
+        self.spool.push("a", values(1, 2))
+        self.spool.push("b", values(3, 4))
+        self.spool.push("c", values(5))
+        self.assertEqual(self.spool.diskRows, 2)
+        self.assertEqual(len(self.spool), 5)
+        self.assertEqual(self.drain(self.spool), [("a", values(1, 2)), ("b", values(3, 4)), ("c", values(5))])
+        self.assertEqual((len(self.spool), self.spool.diskRows), (0, 0))
+        # Once the disk is empty, memory is used again
+        self.spool.push("d", values(6))
+        self.assertEqual(self.spool.diskRows, 0)
+
+    def test_ack_only_oldest(self):
+        self.spool.push("a", values(1))
+        self.spool.push("b", values(2))
+        seq = self.spool.peek()[0]
+        self.spool.ack(seq + 1)
+        self.assertEqual(len(self.spool), 2)
+        self.spool.ack(seq)
+        self.assertEqual(self.spool.peek()[1:], ("b", values(2)))
+
+    def test_survives_restart(self):
+        self.spool.push("a", values(1))
+        self.spool.push("b", values(2, 3, 4))
+        self.spool.close()
+        self.spool = eew_app_a.Spool(self.path, 3)
+        self.assertEqual(len(self.spool), 4)
+        self.spool.push("c", values(5))
+        self.assertEqual(self.drain(self.spool), [("a", values(1)), ("b", values(2, 3, 4)), ("c", values(5))])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# test_swinging_door.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+#
+""" SwingingDoor against the stand-in cbcommslib and cbconfig in bench/ """
+import os
+import sys
+import unittest
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"),
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import eew_app_a
+
+class StoreRecorder:
+    def __init__(self):
+        self.stored = []
+
+    def storeValues(self, deviceID, timeStamp, names, values, latency=None):
+        self.stored.append((timeStamp, values[0]))
+
+class SwingingDoorTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(eew_app_a.config)
+        eew_app_a.config["temp_compression_error"] = 0.5
+        spec = eew_app_a.SERIES["temperature"]
+        self.dm = StoreRecorder()
+        self.door = eew_app_a.SwingingDoor("dev", spec, eew_app_a.SeriesParams(spec, eew_app_a.config), self.dm)
+
+    def tearDown(self):
+        eew_app_a.config.clear()
+        eew_app_a.config.update(self.config)
+
+    def feed(self, samples):
+        for timeStamp, v in samples:
+            self.door.process({"timeStamp": timeStamp, "data": v})
+
+    def assertWithinError(self, samples):
+        """ Each sample up to the last one sent is on the lines between those sent, to within the error """
+        stored = self.dm.stored
+        latest = dict(samples)
+        for t, v in sorted(latest.items()):
+            if t > stored[-1][0]:
+                break
+            for (t0, v0), (t1, v1) in zip(stored, stored[1:]):
+                if t0 <= t <= t1 and t1 > t0:
+                    self.assertLessEqual(abs(v0 + (v1 - v0)*(t - t0)/(t1 - t0) - v), 0.5 + 1e-9)
+                    break
+
+    def test_equal_timestamps(self):
+        # The door closes on a point with the same timestamp as the last one sent
+        self.feed([(0.0, 20.0), (1.0, 20.0), (1.0, 30.0), (1.0, 40.0), (2.0, 40.0), (3.0, 20.0)])
+        self.assertEqual(self.dm.stored, [(0.0, 20.0), (1.0, 20.0), (2.0, 40.0)])
+
+    def test_flood_batch(self):
+        # A whole batch stamped with one time, as the bench's --flood does
+        samples = []
+        for batch in range(5):
+            samples.extend((float(batch), 20.0 + (i % 3)*5) for i in range(10))
+        self.feed(samples)
+        self.assertEqual(self.dm.stored, [(float(t), 20.0) for t in range(5)])
+        self.assertWithinError(samples)
+
+    def test_error_bound(self):
+        samples = [(float(t), 20.0 + (t % 7)*0.3) for t in range(200)]
+        self.feed(samples)
+        self.assertEqual(self.dm.stored[:4], [(0.0, 20.0), (6.0, 21.8), (7.0, 20.0), (13.0, 21.8)])
+        self.assertEqual(len(self.dm.stored), 57)
+        self.assertWithinError(samples)
+
+    def test_steady(self):
+        # Nothing but the first point until the heartbeat
+        samples = [(float(t), 20.0) for t in range(0, 7200, 60)]
+        self.feed(samples)
+        self.assertEqual(self.dm.stored, [(0.0, 20.0), (3600.0, 20.0)])
+
+    def test_out_of_order(self):
+        samples = [(0.0, 20.0), (1.0, 20.1), (2.0, 20.2), (3.0, 20.3), (4.0, 25.0), (5.0, 25.0)]
+        self.feed(samples[:3] + [(1.5, 30.0)] + samples[3:])
+        self.assertEqual(self.dm.stored, [(0.0, 20.0), (3.0, 20.3), (4.0, 25.0)])
+        self.assertEqual((self.door.lastTime, self.door.last), (5.0, 25.0))
+        self.assertWithinError(samples)
+
+if __name__ == '__main__':
+    unittest.main()